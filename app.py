@@ -1,42 +1,76 @@
 import os
 import json
 from pathlib import Path
-from io import BytesIO
-import base64
-from urllib.parse import quote, unquote
+from concurrent.futures import as_completed
 import streamlit as st
-from PIL import Image
 from send2trash import send2trash
 from dotenv import load_dotenv
 
-from core.db import init_db, get_conn
+from core.db import init_db, get_conn, get_count
 from core.indexer import index_folder
-from core.search import search
+from core.retag import retag
+from core.search import search, similar
 from core.db_delete import mark_deleted
+from core.image_server import get_image_server
 from utils.paths import safe_exists
 from utils.clipboard import cut_files_to_clipboard
+from utils.metrics import METRICS
+from utils.thumbs import THUMB_PX, get_thumb_cache, get_thumb_pool
 
 load_dotenv(dotenv_path=Path(__file__).resolve().parent / ".env", override=True)
 
 st.set_page_config(page_title="AI Photo Gallery Manager", layout="wide")
 
 HISTORY_PATH = Path(__file__).resolve().parent / ".index_history.json"
-THUMB_PX = 220
-PREVIEW_PX = 900
-
-def _img_to_data_uri(img: Image.Image) -> str:
-    buf = BytesIO()
-    img.save(buf, format="JPEG", quality=85)
-    b64 = base64.b64encode(buf.getvalue()).decode("ascii")
-    return f"data:image/jpeg;base64,{b64}"
-
-def _make_thumb_and_preview(path: str):
-    img = Image.open(path).convert("RGB")
-    thumb = img.copy()
-    thumb.thumbnail((THUMB_PX, THUMB_PX))
-    preview = img.copy()
-    preview.thumbnail((PREVIEW_PX, PREVIEW_PX))
-    return thumb, preview
+PAGE_SIZE = 60
+
+def _load_thumb(path: str):
+    # Runs on the thumbnail pool. Makes sure the thumbnail is cached and
+    # returns the file's mtime for the image URLs; None means the file is gone.
+    if not safe_exists(path):
+        return None
+    version = os.stat(path).st_mtime_ns
+    get_thumb_cache().get_or_create(path)
+    return version
+
+def _turn_page(step: int):
+    st.session_state["page"] = max(0, st.session_state.get("page", 0) + step)
+
+def _metrics_panel():
+    snap = METRICS.snapshot()
+    with st.sidebar.expander("Metrics"):
+        if not (snap["histograms"] or snap["counters"]):
+            st.caption("Nothing recorded yet.")
+            return
+        st.caption("Timings (ms)")
+        st.dataframe(
+            [
+                {
+                    "metric": h["name"],
+                    "labels": ", ".join(f"{k}={v}" for k, v in h["labels"].items()),
+                    "count": h["count"],
+                    "mean": 1000 * h["sum"] / max(h["count"], 1),
+                    "p50": 1000 * h["p50"],
+                    "p95": 1000 * h["p95"],
+                }
+                for h in snap["histograms"]
+            ],
+            hide_index=True,
+        )
+        st.caption("Counters")
+        st.dataframe(
+            [
+                {
+                    "metric": c["name"],
+                    "labels": ", ".join(f"{k}={v}" for k, v in c["labels"].items()),
+                    "value": c["value"],
+                }
+                for c in snap["counters"]
+            ],
+            hide_index=True,
+        )
+        st.caption(f"Prometheus: {get_image_server().base_url}/metrics")
+        st.download_button("Download JSON", METRICS.to_json(), file_name="metrics.json", mime="application/json")
 
 def _load_history():
     try:
@@ -71,24 +105,6 @@ def main():
         unsafe_allow_html=True,
     )
 
-    params = st.query_params
-    view_param = params.get("view")
-    if view_param:
-        st.subheader("Image preview")
-        path = unquote(view_param)
-        if not safe_exists(path):
-            st.error("File does not exist.")
-            st.text(path)
-            return
-        try:
-            img = Image.open(path)
-            st.image(img, use_container_width=True)
-        except Exception as e:
-            st.error("Cannot render image preview.")
-            st.code(str(e))
-        st.markdown("[Back to search](./)")
-        return
-
     with st.sidebar:
         st.header("Indexing")
         history = _load_history()
@@ -120,9 +136,13 @@ def main():
                 if folder:
                     new_history = [folder] + [p for p in history if p != folder]
                     _save_history(new_history[:20])
+        if st.button("Re-tag from captions", help="Recompute tags from stored captions, without any API calls."):
+            with st.spinner("Re-tagging..."):
+                scanned, changed = retag(folder if os.path.isdir(folder) else None)
+            st.success(f"Re-tagged {scanned} photos, {changed} changed.")
         try:
             conn = get_conn()
-            total = conn.execute("SELECT COUNT(*) FROM images WHERE deleted=0").fetchone()[0]
+            total = get_count(conn)
             conn.close()
             st.caption(f"Indexed items: {total}")
         except Exception:
@@ -137,10 +157,17 @@ def main():
             for p in missing_in_sidebar:
                 st.write(Path(p).name)
 
-    st.header("Search")
-    query = st.text_input("What image are you looking for?")
-
-    if query:
+    similar_param = st.query_params.get("similar")
+    similar_to = int(similar_param) if similar_param and similar_param.isdigit() else None
+    if similar_to is not None:
+        st.header("More like this")
+        st.markdown("[New search](./)")
+        query = ""
+    else:
+        st.header("Search")
+        query = st.text_input("What image are you looking for?")
+
+    if query or similar_to is not None:
         with st.expander("Filters"):
             st.caption("Filters use indexed tags. Re-index to populate tags on older items.")
             exclude_people = st.checkbox("Exclude people", value=False)
@@ -149,6 +176,12 @@ def main():
             only_documents = st.checkbox("Only documents", value=False)
             only_screenshots = st.checkbox("Only screenshots", value=False)
             environment = st.radio("Environment", ["Any", "Indoor", "Outdoor"], horizontal=True)
+            match_mode = st.radio(
+                "Match",
+                ["Meaning + keywords", "Meaning only", "Keywords only (offline)"],
+                horizontal=True,
+            )
+            speed = st.radio("Speed", ["Default", "Faster", "Most accurate"], horizontal=True)
 
         filters = {
             "exclude_people": exclude_people,
@@ -183,53 +216,98 @@ def main():
                 border: 1px solid #ddd;
                 cursor: zoom-in;
             }}
+            .similar-link {{
+                font-size: 0.8rem;
+            }}
             </style>
             """.format(
             thumb_px=THUMB_PX,
         )
         st.markdown(css, unsafe_allow_html=True)
 
-        results = search(query=query, limit=60, filters=filters)
+        mode = {
+            "Meaning + keywords": "hybrid",
+            "Meaning only": "semantic",
+            "Keywords only (offline)": "lexical",
+        }[match_mode]
+        coarse = {"Default": None, "Faster": 3, "Most accurate": 0}[speed]
+        def fetch(offset, limit):
+            if similar_to is not None:
+                return similar(similar_to, limit=limit, filters=filters, offset=offset)
+            return search(query=query, limit=limit, filters=filters, mode=mode, coarse=coarse, offset=offset)
+
+        # A new search starts again from the first page.
+        search_key = (query, similar_to, tuple(sorted(filters.items())), mode, coarse)
+        if st.session_state.get("search_key") != search_key:
+            st.session_state["search_key"] = search_key
+            st.session_state["page"] = 0
+        page = st.session_state.get("page", 0)
+        offset = page * PAGE_SIZE
+        # One extra result tells whether there is a next page.
+        results = fetch(offset, PAGE_SIZE + 1)
+        has_next = len(results) > PAGE_SIZE
+        results = results[:PAGE_SIZE]
         sort_mode = st.radio("Sort by", options=["Relevance", "Filename"], horizontal=True)
         if sort_mode == "Filename":
             results = sorted(results, key=lambda r: Path(r["path"]).name.lower())
-        st.caption(f"{len(results)} results")
+
+        # Thumbnails are made on the pool while the grid is laid out, and
+        # each slot is filled as soon as its thumbnail is ready.
+        pool = get_thumb_pool()
+        images = get_image_server()
+        futures = {pool.submit(_load_thumb, r["path"]): i for i, r in enumerate(results)}
+
+        nav_prev, nav_info, nav_next = st.columns([1, 4, 1])
+        nav_prev.button("Previous", on_click=_turn_page, args=(-1,), disabled=page == 0)
+        if results:
+            nav_info.caption(f"Results {offset + 1}-{offset + len(results)}")
+        else:
+            nav_info.caption("No results")
+        nav_next.button("Next", on_click=_turn_page, args=(1,), disabled=not has_next)
 
         selected_paths = []
         missing_files = []
         with st.form("results_form"):
             cols = st.columns(4)
 
+            slots = []
             for i, r in enumerate(results):
-                col = cols[i % 4]
-                with col:
-                    path = r["path"]
-
-                    if not safe_exists(path):
-                        missing_files.append(path)
-                        continue
+                with cols[i % 4]:
+                    slots.append(st.empty())
+                    tick = st.checkbox("Select", key=f"sel_{r['id']}")
+                    if tick:
+                        selected_paths.append(r["path"])
 
-                    try:
-                        thumb, _preview = _make_thumb_and_preview(path)
-                        thumb_uri = _img_to_data_uri(thumb)
-                        view_href = f"?view={quote(path)}"
-                        st.markdown(
-                            f"""
-                            <div class="thumb-wrap">
-                              <a class="thumb-link" href="{view_href}" target="_blank" rel="noopener">
-                                <img class="thumb-img" src="{thumb_uri}" />
-                              </a>
-                            </div>
-                            """,
-                            unsafe_allow_html=True,
-                        )
-                    except Exception:
+            for future in as_completed(futures):
+                i = futures[future]
+                path = results[i]["path"]
+                slot = slots[i]
+                try:
+                    version = future.result()
+                except Exception:
+                    with slot.container():
                         st.warning("Cannot render image preview")
                         st.text(path)
-
-                    tick = st.checkbox("Select", key=f"sel_{r['id']}")
-                    if tick:
-                        selected_paths.append(path)
+                    continue
+                if version is None:
+                    missing_files.append(path)
+                    slot.caption(f"Missing: {Path(path).name}")
+                    continue
+                img_id = results[i]["id"]
+                slot.markdown(
+                    f"""
+                    <div class="thumb-wrap">
+                      <a class="thumb-link" href="{images.url('preview', img_id, version)}" target="_blank" rel="noopener">
+                        <img class="thumb-img" src="{images.url('thumb', img_id, version)}" />
+                      </a>
+                    </div>
+                    <a class="similar-link" href="?similar={img_id}" target="_blank" rel="noopener">More like this</a>
+                    """,
+                    unsafe_allow_html=True,
+                )
+            if missing_files:
+                missing = set(missing_files)
+                selected_paths = [p for p in selected_paths if p not in missing]
 
             st.divider()
             st.subheader("Actions")
@@ -238,6 +316,11 @@ def main():
             do_cut = st.form_submit_button("Cut selected to Clipboard")
             do_delete = st.form_submit_button("Send selected to Recycle Bin")
 
+        if has_next:
+            # Warm the thumbnail cache for the next page while this one is viewed.
+            for r in fetch(offset + PAGE_SIZE, PAGE_SIZE):
+                pool.submit(_load_thumb, r["path"])
+
         if do_cut:
             if not selected_paths:
                 st.info("No images selected.")
@@ -274,5 +357,7 @@ def main():
 
         st.session_state["missing_files"] = missing_files
 
+    _metrics_panel()
+
 if __name__ == "__main__":
     main()
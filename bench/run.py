@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+os.environ["AI_PROVIDER"] = "local"
+
+from core import db
+from core import emb_index, search as search_mod
+from core.indexer import index_folder
+from bench.synthetic import make_gallery, populate_db
+from providers.local_provider import PLACES, SUBJECTS
+from utils import thumbs as thumbs_mod
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS bytes.
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb
+        )
+        return counters.PeakWorkingSetSize / (1024 * 1024)
+
+def use_database(path: Path):
+    db.DB_PATH = path
+    db.init_db()
+    emb_index._INDEX.reset()
+    search_mod.clear_caches()
+
+def bench_indexing(workdir: Path, count: int, size) -> dict:
+    gallery = workdir / "gallery"
+    make_gallery(str(gallery), count, size)
+    use_database(workdir / "index.db")
+    thumbs_mod._CACHE = thumbs_mod.ThumbCache(root=workdir / "thumbs")
+
+    start = time.perf_counter()
+    index_folder(str(gallery))
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index_folder(str(gallery))
+    rescan = time.perf_counter() - start
+    return {
+        "images": count,
+        "images_per_sec": count / elapsed if elapsed else 0.0,
+        "noop_rescan_s": rescan,
+    }
+
+def bench_thumbnails(workdir: Path, count: int) -> dict:
+    paths = [str(p) for p in sorted((workdir / "gallery").rglob("*.jpg"))[:count]]
+    cache = thumbs_mod.ThumbCache(root=workdir / "thumbs-bench")
+    start = time.perf_counter()
+    for p in paths:
+        cache.get_or_create(p)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    for p in paths:
+        cache.get_or_create(p)
+    warm = time.perf_counter() - start
+    return {
+        "thumbs": len(paths),
+        "cold_per_sec": len(paths) / cold if cold else 0.0,
+        "warm_per_sec": len(paths) / warm if warm else 0.0,
+    }
+
+def _queries(n: int):
+    for i in range(n):
+        yield f"{SUBJECTS[i % len(SUBJECTS)]} {PLACES[(i // len(SUBJECTS)) % len(PLACES)]} #{i}"
+
+def bench_search(workdir: Path, sizes, dim: int, queries: int, limit: int, build_ann: bool) -> list:
+    os.environ["LOCAL_EMBED_DIM"] = str(dim)
+    search_mod.PERSIST_QUERY_EMBEDDINGS = False
+    use_database(workdir / "search.db")
+    quantized_setting = search_mod.QUANTIZED_SCAN
+    out = []
+    for size in sizes:
+        start = time.perf_counter()
+        populate_db(size, dim)
+        populate_s = time.perf_counter() - start
+
+        emb_index._INDEX.reset()
+        search_mod.clear_caches()
+        start = time.perf_counter()
+        emb_index.get_index()
+        cold_load = time.perf_counter() - start
+
+        row = {"rows": size, "populate_s": populate_s, "cold_load_s": cold_load}
+        # (name, nprobe, coarse, SEARCH_QUANTIZED); "exact" turns off every
+        # approximate pass, "default" is what the app does at this size.
+        modes = [("exact", 0, 0, "0"), ("default", 0, None, quantized_setting)]
+        if build_ann:
+            from core.ann import build_ann_index
+            start = time.perf_counter()
+            build_ann_index()
+            row["ann_build_s"] = time.perf_counter() - start
+            modes.append(("ann", None, None, quantized_setting))
+
+        for name, nprobe, coarse, quantized in modes:
+            search_mod.clear_caches()
+            search_mod.QUANTIZED_SCAN = quantized
+            latencies = []
+            for q in _queries(queries):
+                start = time.perf_counter()
+                search_mod.search(q, limit=limit, nprobe=nprobe, coarse=coarse)
+                latencies.append(time.perf_counter() - start)
+            row[f"{name}_p50_ms"] = float(np.percentile(latencies, 50) * 1000)
+            row[f"{name}_p99_ms"] = float(np.percentile(latencies, 99) * 1000)
+        out.append(row)
+        print(json.dumps(row), flush=True)
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline indexing and search benchmarks using the local provider.")
+    parser.add_argument("--images", type=int, default=200, help="Synthetic images to index.")
+    parser.add_argument("--image-size", default="2000x1500", help="WxH of synthetic images.")
+    parser.add_argument("--caption-latency-ms", type=float, default=0.0)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Row counts for search latency.")
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension for search rows.")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=60)
+    parser.add_argument("--ann", action="store_true", help="Also build and time the IVF index.")
+    parser.add_argument("--skip-indexing", action="store_true")
+    parser.add_argument("--skip-search", action="store_true")
+    parser.add_argument("--workdir", default=None, help="Reuse a work directory (default: temporary).")
+    parser.add_argument("--output", default=None, help="Write the JSON report here.")
+    args = parser.parse_args()
+
+    os.environ["LOCAL_CAPTION_LATENCY_MS"] = str(args.caption_latency_ms)
+    os.environ["LOCAL_EMBED_LATENCY_MS"] = str(args.embed_latency_ms)
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="gallery-bench-"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    w, h = (int(x) for x in args.image_size.lower().split("x"))
+
+    report = {}
+    try:
+        if not args.skip_indexing:
+            report["indexing"] = bench_indexing(workdir, args.images, (w, h))
+            report["thumbnails"] = bench_thumbnails(workdir, args.images)
+            print(json.dumps({"indexing": report["indexing"], "thumbnails": report["thumbnails"]}), flush=True)
+        if not args.skip_search:
+            sizes = [int(s) for s in args.sizes.split(",") if s]
+            report["search"] = bench_search(workdir, sizes, args.dim, args.queries, args.limit, args.ann)
+        report["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import os
+import random
+import sqlite3
+from typing import List
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from core.db import TAGS, bump_generation, get_conn
+from providers.local_provider import PLACES, SUBJECTS
+
+def make_gallery(folder: str, count: int, size=(2000, 1500), seed: int = 0) -> List[str]:
+    # Photo-sized JPEGs with enough structure that decode and re-encode cost
+    # resembles real photos; reruns reuse files that already exist.
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f"{i // 1000:03d}", f"img_{i:06d}.jpg")
+        paths.append(path)
+        if os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        w, h = size
+        img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(40):
+            x0, y0 = rng.randrange(w), rng.randrange(h)
+            x1, y1 = x0 + rng.randrange(w // 2), y0 + rng.randrange(h // 2)
+            color = tuple(rng.randrange(256) for _ in range(3))
+            if rng.random() < 0.5:
+                draw.rectangle((x0, y0, x1, y1), fill=color)
+            else:
+                draw.ellipse((x0, y0, x1, y1), fill=color)
+        noise = Image.effect_noise(size, 24).convert("RGB")
+        img = Image.blend(img, noise, 0.15)
+        img.save(path, format="JPEG", quality=90)
+    return paths
+
+def populate_db(count: int, dim: int, seed: int = 0, batch: int = 10_000, clusters: int = 64) -> int:
+    # Tops the images table up to `count` rows of clustered random vectors,
+    # bypassing the provider entirely.
+    conn = get_conn()
+    start = conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    rng = np.random.default_rng(seed + start)
+    all_known = (1 << len(TAGS)) - 1
+    for lo in range(start, count, batch):
+        n = min(batch, count - lo)
+        labels = rng.integers(0, clusters, n)
+        vecs = centers[labels] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+        tag_bits = rng.integers(0, all_known + 1, n)
+        rows = [
+            (
+                f"/synthetic/{lo + i:07d}.jpg",
+                1.0,
+                f"{SUBJECTS[labels[i] % len(SUBJECTS)]} {PLACES[labels[i] % len(PLACES)]}",
+                sqlite3.Binary(vecs[i].tobytes()),
+                int(tag_bits[i]),
+                all_known,
+            )
+            for i in range(n)
+        ]
+        conn.executemany(
+            "INSERT INTO images(path, mtime, caption, embedding, tag_bits, tag_known) VALUES(?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        bump_generation(conn)
+        conn.commit()
+    conn.close()
+    return max(count, start)
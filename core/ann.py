@@ -0,0 +1,177 @@
+import argparse
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from core import db
+from core.emb_store import EmbeddingStore, get_store
+
+# Inverted-file (IVF) index over the sidecar store: spherical k-means
+# centroids partition the embeddings, and a query only scores the rows
+# assigned to its `nprobe` closest centroids. Assignments are addressed by
+# images.id like everything else, so incremental adds are a single write.
+DEFAULT_NPROBE = int(os.getenv("ANN_NPROBE", "16"))
+TRAIN_SAMPLE = 100_000
+BLOCK_ROWS = 16_384
+
+def ann_path(db_path: Optional[Path] = None) -> Path:
+    return Path(db_path or db.DB_PATH).with_suffix(".ivf.npz")
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    out = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        block = vectors[start:start + BLOCK_ROWS]
+        out[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+def _normalize_rows(m: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return m / norms
+
+def train_centroids(vectors: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    nlist = max(1, min(nlist, len(vectors)))
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        counts = np.bincount(labels, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # Re-seed dead centroids from random points so every list is used.
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = _normalize_rows(sums)
+    return centroids.astype(np.float32)
+
+class IVFIndex:
+    def __init__(self, centroids: np.ndarray, assign: np.ndarray):
+        self._lock = threading.RLock()
+        self.centroids = centroids
+        self.assign = assign
+        self._order = None
+        self._offsets = None
+        self.dirty = False
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    def add(self, img_id: int, vec: np.ndarray):
+        vec = np.asarray(vec, dtype=np.float32)
+        label = int(np.argmax(self.centroids @ vec))
+        with self._lock:
+            if img_id >= len(self.assign):
+                grown = np.full(max(img_id + 1, int(len(self.assign) * 1.5) + 1024), -1, dtype=np.int32)
+                grown[:len(self.assign)] = self.assign
+                self.assign = grown
+            self.assign[img_id] = label
+            self._order = None
+            self.dirty = True
+
+    def _lists(self):
+        if self._order is None:
+            self._order = np.argsort(self.assign, kind="stable").astype(np.int64)
+            self._offsets = np.searchsorted(self.assign[self._order], np.arange(self.nlist + 1))
+        return self._order, self._offsets
+
+    def candidates(self, q: np.ndarray, nprobe: int) -> np.ndarray:
+        probe = np.argsort(-(self.centroids @ q))[:max(1, nprobe)]
+        with self._lock:
+            order, offsets = self._lists()
+            parts = [order[offsets[c]:offsets[c + 1]] for c in probe]
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(parts)
+
+    def save(self, path: Optional[Path] = None):
+        path = Path(path or ann_path())
+        tmp = path.with_name(path.name + ".tmp")
+        with self._lock:
+            with tmp.open("wb") as f:
+                np.savez(f, centroids=self.centroids, assign=self.assign)
+            tmp.replace(path)
+            self.dirty = False
+
+    @classmethod
+    def load(cls, path: Optional[Path] = None) -> "IVFIndex":
+        with np.load(Path(path or ann_path())) as data:
+            return cls(data["centroids"], data["assign"])
+
+def build_ann_index(nlist: Optional[int] = None, store: Optional[EmbeddingStore] = None) -> IVFIndex:
+    store = store or get_store()
+    live_ids = np.flatnonzero(store.live_mask())
+    if len(live_ids) == 0:
+        raise RuntimeError("No embeddings to index.")
+    if nlist is None:
+        nlist = max(1, int(4 * np.sqrt(len(live_ids))))
+
+    rng = np.random.default_rng(0)
+    sample_ids = live_ids
+    if len(live_ids) > TRAIN_SAMPLE:
+        sample_ids = np.sort(rng.choice(live_ids, TRAIN_SAMPLE, replace=False))
+    centroids = train_centroids(store.vectors(sample_ids), nlist)
+
+    assign = np.full(store.count, -1, dtype=np.int32)
+    for start in range(0, len(live_ids), BLOCK_ROWS):
+        ids = live_ids[start:start + BLOCK_ROWS]
+        assign[ids] = _assign(store.vectors(ids), centroids)
+
+    index = IVFIndex(centroids, assign)
+    index.save()
+    _reset_cache()
+    return index
+
+_ANN = None
+_ANN_MTIME = None
+_ANN_LOCK = threading.Lock()
+
+def _reset_cache():
+    global _ANN, _ANN_MTIME
+    with _ANN_LOCK:
+        _ANN = None
+        _ANN_MTIME = None
+
+def get_ann() -> Optional[IVFIndex]:
+    global _ANN, _ANN_MTIME
+    path = ann_path()
+    with _ANN_LOCK:
+        try:
+            mtime = path.stat().st_mtime
+        except OSError:
+            _ANN = None
+            return None
+        # Unsaved local additions win over a file another process rewrote.
+        if _ANN is None or (mtime != _ANN_MTIME and not _ANN.dirty):
+            _ANN = IVFIndex.load(path)
+            _ANN_MTIME = mtime
+        return _ANN
+
+def notify_ann(img_id: int, vec: np.ndarray):
+    ann = get_ann()
+    if ann is not None:
+        ann.add(img_id, vec)
+
+def save_ann():
+    global _ANN_MTIME
+    with _ANN_LOCK:
+        if _ANN is not None and _ANN.dirty:
+            _ANN.save()
+            _ANN_MTIME = ann_path().stat().st_mtime
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the approximate nearest-neighbour index.")
+    parser.add_argument("--nlist", type=int, default=None, help="Number of clusters (default 4*sqrt(n)).")
+    args = parser.parse_args()
+    from core.emb_index import get_index
+    db.init_db()
+    get_index()
+    index = build_ann_index(args.nlist)
+    print(f"Built IVF index with {index.nlist} lists at {ann_path()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+import argparse
+import json
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from core import db
+from core.ann import save_ann
+from core.db import get_conn, init_db
+from core.db_delete import mark_deleted
+from core.emb_store import get_store
+from core.indexer import LOAD_WORKERS, floats_to_bytes, lookup_cached, publish, upsert_image
+from core.neighbours import update_if_built as update_neighbours_if_built
+from core.scanner import FolderScan
+from providers import get_provider
+from providers.batch import (
+    CAPTION_ENDPOINT,
+    EMBED_ENDPOINT,
+    MAX_BATCH_BYTES,
+    MAX_BATCH_REQUESTS,
+    caption_request,
+    embed_request,
+    embedding,
+    get_batch_backend,
+    iter_results,
+    response_text,
+)
+from providers.openai_provider import parse_caption_reply
+from utils.images import load_image
+from utils.thumbs import get_thumb_cache
+
+# Offline indexing for large backfills. Changed files are written into JSONL
+# caption requests and submitted as asynchronous batch jobs; captions that
+# come back are embedded by a second round of jobs, and finished items are
+# written with upsert_image like the live indexer does. Every step is recorded
+# in batch_jobs / batch_items, so running this again after a crash, or from a
+# scheduled task, picks up wherever the last run stopped.
+#
+# Item states: pending (waiting for a caption), captioned (waiting for an
+# embedding), done, failed. Failed items are retried by the next prepare.
+# Job statuses: prepared (written, not yet submitted), submitted, done, failed.
+LOAD_CHUNK = 256
+
+def batch_dir() -> Path:
+    return Path(db.DB_PATH).with_suffix(".batches")
+
+class _JobWriter:
+    # Streams request lines into one JSONL file per job, starting a new job
+    # whenever the batch API's request-count or size limit would be exceeded.
+    def __init__(self, conn: sqlite3.Connection, kind: str, item_column: str):
+        self.conn = conn
+        self.kind = kind
+        self.item_column = item_column
+        self.jobs = 0
+        self._open()
+
+    def _open(self):
+        self.key = uuid.uuid4().hex
+        self.path = batch_dir() / f"{self.kind}-{self.key}.jsonl"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp = self.path.with_name(self.path.name + ".tmp")
+        self.f = self.tmp.open("w", encoding="utf-8")
+        self.items: List[int] = []
+        self.bytes = 0
+
+    def add(self, item_id: int, request: Dict):
+        line = json.dumps(request) + "\n"
+        if self.items and (
+            len(self.items) >= MAX_BATCH_REQUESTS or self.bytes + len(line) > MAX_BATCH_BYTES
+        ):
+            self.finish()
+            self._open()
+        self.f.write(line)
+        self.items.append(item_id)
+        self.bytes += len(line)
+
+    def finish(self):
+        self.f.close()
+        if not self.items:
+            self.tmp.unlink()
+            return
+        self.tmp.replace(self.path)
+        now = time.time()
+        job_id = self.conn.execute(
+            "INSERT INTO batch_jobs(kind, key, input_path, status, created, updated) "
+            "VALUES(?, ?, ?, 'prepared', ?, ?) RETURNING id",
+            (self.kind, self.key, str(self.path), now, now),
+        ).fetchone()[0]
+        self.conn.executemany(
+            f"UPDATE batch_items SET {self.item_column}=? WHERE id=?",
+            [(job_id, item_id) for item_id in self.items],
+        )
+        self.conn.commit()
+        self.jobs += 1
+        self.items = []
+
+def _discard_unfinished(conn: sqlite3.Connection):
+    # Items inserted by a prepare that died before its job file was complete.
+    conn.execute("DELETE FROM batch_items WHERE state='pending' AND caption_job IS NULL")
+    conn.commit()
+    for tmp in batch_dir().glob("*.jsonl.tmp"):
+        tmp.unlink()
+
+def prepare(conn: sqlite3.Connection, folder: str, provider, load_workers: Optional[int] = None) -> int:
+    _discard_unfinished(conn)
+    in_progress = {
+        path for (path,) in conn.execute(
+            "SELECT path FROM batch_items WHERE state IN ('pending', 'captioned')"
+        )
+    }
+    scan = FolderScan(conn, folder)
+    jobs = [(path, mtime, size) for path, mtime, size, _known, _changed in scan if path not in in_progress]
+
+    thumbs = get_thumb_cache()
+
+    def load(job):
+        path, mtime, size = job
+        conn = get_conn()
+        try:
+            content_hash, cached = lookup_cached(conn, path)
+            img_bytes = phash = None
+            if cached is None:
+                img_bytes, phash = load_image(
+                    path,
+                    max_side=provider.upload_max_side,
+                    quality=provider.upload_quality,
+                    thumb_cache=thumbs,
+                )
+            return path, mtime, size, content_hash, cached, img_bytes, phash
+        except Exception as e:
+            print(f"[WARN] Failed reading {path}: {e}")
+            return None
+        finally:
+            conn.close()
+
+    writer = _JobWriter(conn, "caption", "caption_job")
+    queued = 0
+    after_commit = []
+    with ThreadPoolExecutor(max_workers=load_workers or LOAD_WORKERS, thread_name_prefix="batch-load") as pool:
+        for start in range(0, len(jobs), LOAD_CHUNK):
+            # Decode the whole chunk before writing, so the write lock is only
+            # held for the inserts.
+            chunk = list(pool.map(load, jobs[start:start + LOAD_CHUNK]))
+            for loaded in chunk:
+                if loaded is None:
+                    continue
+                path, mtime, size, content_hash, cached, img_bytes, phash = loaded
+                if cached is not None:
+                    caption, tags, emb_blob, vec = cached
+                    if emb_blob is not None:
+                        upsert_image(
+                            conn, path, mtime, caption, emb_blob, tags, content_hash, size, None, vec,
+                            after_commit=after_commit,
+                        )
+                    else:
+                        conn.execute(
+                            "INSERT INTO batch_items(path, mtime, size, content_hash, caption, tags, state) "
+                            "VALUES(?, ?, ?, ?, ?, ?, 'captioned')",
+                            (path, mtime, size, content_hash, caption, json.dumps(tags)),
+                        )
+                    continue
+                item_id = conn.execute(
+                    "INSERT INTO batch_items(path, mtime, size, content_hash, phash, state) "
+                    "VALUES(?, ?, ?, ?, ?, 'pending') RETURNING id",
+                    (path, mtime, size, content_hash, phash),
+                ).fetchone()[0]
+                writer.add(item_id, caption_request(str(item_id), img_bytes))
+                queued += 1
+            conn.commit()
+            publish(after_commit)
+    writer.finish()
+    conn.commit()
+
+    if scan.vanished:
+        mark_deleted(scan.vanished)
+    return queued
+
+def queue_embeddings(conn: sqlite3.Connection) -> int:
+    writer = _JobWriter(conn, "embed", "embed_job")
+    rows = conn.execute(
+        "SELECT id, caption FROM batch_items WHERE state='captioned' AND embed_job IS NULL"
+    ).fetchall()
+    for item_id, caption in rows:
+        writer.add(item_id, embed_request(str(item_id), caption))
+    writer.finish()
+    return len(rows)
+
+def submit_jobs(conn: sqlite3.Connection, backend) -> int:
+    rows = conn.execute(
+        "SELECT id, kind, key, input_path FROM batch_jobs WHERE status='prepared' ORDER BY id"
+    ).fetchall()
+    for job_id, kind, key, input_path in rows:
+        endpoint = CAPTION_ENDPOINT if kind == "caption" else EMBED_ENDPOINT
+        remote_id = backend.submit(Path(input_path), endpoint, key)
+        conn.execute(
+            "UPDATE batch_jobs SET remote_id=?, status='submitted', updated=? WHERE id=?",
+            (remote_id, time.time(), job_id),
+        )
+        conn.commit()
+    return len(rows)
+
+def _ingest_captions(conn: sqlite3.Connection, job_id: int, output: str, provider):
+    for custom_id, body in iter_results(output):
+        if body is None:
+            continue
+        text = response_text(body)
+        parsed = parse_caption_reply(text)
+        caption, tags = parsed if parsed is not None else (text, provider.tags_from_caption(text))
+        if not caption:
+            continue
+        conn.execute(
+            "UPDATE batch_items SET caption=?, tags=?, state='captioned' "
+            "WHERE id=? AND caption_job=? AND state='pending'",
+            (caption, json.dumps(tags), int(custom_id), job_id),
+        )
+    conn.execute("UPDATE batch_items SET state='failed' WHERE caption_job=? AND state='pending'", (job_id,))
+
+def _ingest_embeddings(conn: sqlite3.Connection, job_id: int, output: str, after_commit: List):
+    written = 0
+    for custom_id, body in iter_results(output):
+        if body is None:
+            continue
+        row = conn.execute(
+            "SELECT path, mtime, size, content_hash, caption, tags, phash FROM batch_items "
+            "WHERE id=? AND embed_job=? AND state='captioned'",
+            (int(custom_id), job_id),
+        ).fetchone()
+        if row is None:
+            continue
+        path, mtime, size, content_hash, caption, tags, phash = row
+        vec = np.asarray(embedding(body), dtype=np.float32)
+        emb_blob = sqlite3.Binary(floats_to_bytes(vec))
+        upsert_image(
+            conn, path, mtime, caption, emb_blob, json.loads(tags or "{}"), content_hash, size, phash, vec,
+            after_commit=after_commit,
+        )
+        conn.execute("UPDATE batch_items SET state='done' WHERE id=?", (int(custom_id),))
+        written += 1
+    conn.execute("UPDATE batch_items SET state='failed' WHERE embed_job=? AND state='captioned'", (job_id,))
+    return written
+
+def poll_jobs(conn: sqlite3.Connection, backend, provider) -> int:
+    written = 0
+    after_commit = []
+    rows = conn.execute(
+        "SELECT id, kind, input_path, remote_id FROM batch_jobs WHERE status='submitted' ORDER BY id"
+    ).fetchall()
+    for job_id, kind, input_path, remote_id in rows:
+        remote_status, output = backend.fetch(remote_id)
+        if output is None:
+            continue
+        # Results, item states and the job's own status commit together, so
+        # a crash part-way through means the job is simply ingested again.
+        if kind == "caption":
+            _ingest_captions(conn, job_id, output, provider)
+        else:
+            written += _ingest_embeddings(conn, job_id, output, after_commit)
+        status = "done" if remote_status == "completed" else "failed"
+        conn.execute("UPDATE batch_jobs SET status=?, updated=? WHERE id=?", (status, time.time(), job_id))
+        conn.commit()
+        publish(after_commit)
+        Path(input_path).unlink(missing_ok=True)
+        if status == "failed":
+            print(f"[WARN] Batch job {remote_id} ended as {remote_status}; unfinished items will be retried")
+    return written
+
+def batch_status(conn: sqlite3.Connection) -> Dict[str, int]:
+    out = {f"items_{state}": n for state, n in conn.execute(
+        "SELECT state, COUNT(*) FROM batch_items GROUP BY state"
+    )}
+    out.update({f"jobs_{status}": n for status, n in conn.execute(
+        "SELECT status, COUNT(*) FROM batch_jobs GROUP BY status"
+    )})
+    return out
+
+def _outstanding(conn: sqlite3.Connection) -> bool:
+    return conn.execute(
+        "SELECT EXISTS(SELECT 1 FROM batch_jobs WHERE status IN ('prepared', 'submitted')) "
+        "OR EXISTS(SELECT 1 FROM batch_items WHERE state='captioned' AND embed_job IS NULL)"
+    ).fetchone()[0] == 1
+
+def run_batch(folder: Optional[str] = None, wait: bool = False, poll_seconds: float = 60.0, backend=None):
+    provider = get_provider()
+    backend = backend or get_batch_backend(provider, batch_dir() / "local")
+    conn = get_conn()
+    written = 0
+    try:
+        if folder:
+            queued = prepare(conn, folder, provider)
+            print(f"[INFO] Queued {queued} images for batch captioning")
+        while True:
+            written += poll_jobs(conn, backend, provider)
+            queue_embeddings(conn)
+            submit_jobs(conn, backend)
+            if not wait or not _outstanding(conn):
+                break
+            time.sleep(poll_seconds)
+        status = batch_status(conn)
+    finally:
+        conn.close()
+    get_store().flush()
+    save_ann()
+    if written:
+        update_neighbours_if_built()
+    print(f"[INFO] Indexed {written} images from batch results; {status}")
+    return status
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index a folder through asynchronous batch jobs. Run again to submit, poll and ingest."
+    )
+    parser.add_argument("folder", nargs="?", help="Folder to queue for indexing.")
+    parser.add_argument("--wait", action="store_true", help="Keep polling until every job has been ingested.")
+    parser.add_argument("--poll-seconds", type=float, default=60.0)
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=Path(__file__).resolve().parent.parent / ".env", override=True)
+    init_db()
+    run_batch(args.folder, wait=args.wait, poll_seconds=args.poll_seconds)
+
+if __name__ == "__main__":
+    main()
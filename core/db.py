@@ -1,13 +1,128 @@
+import os
 import sqlite3
+import threading
 from pathlib import Path
 
-DB_PATH = Path(__file__).resolve().parent.parent / "gallery.db"
+DB_PATH = Path(os.getenv("GALLERY_DB") or Path(__file__).resolve().parent.parent / "gallery.db")
 
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
+# Tags are stored as two bitmasks per image: tag_bits holds the flags that
+# are set and tag_known the flags that were determined at all (the rest are
+# NULL/unknown). A tag's bit is its position in TAGS, so new tags are
+# appended here without touching the schema; at most 16 fit the uint16
+# arrays mirrored in memory.
+TAGS = [
+    "has_people",
+    "has_faces",
+    "has_text",
+    "is_indoor",
+    "is_outdoor",
+    "is_document",
+    "is_screenshot",
+]
+TAG_BITS = {name: 1 << i for i, name in enumerate(TAGS)}
+
+# Per-tag INTEGER columns used before the bitmasks; read once to migrate.
+LEGACY_TAG_COLUMNS = [
+    "has_people",
+    "has_faces",
+    "has_text",
+    "is_indoor",
+    "is_outdoor",
+    "is_document",
+    "is_screenshot",
+]
+
+def pack_tags(tags) -> tuple:
+    bits = known = 0
+    for name, bit in TAG_BITS.items():
+        value = tags.get(name)
+        if value is not None:
+            known |= bit
+            if value:
+                bits |= bit
+    return bits, known
+
+def unpack_tags(bits: int, known: int) -> dict:
+    return {
+        name: (int(bool(bits & bit)) if known & bit else None)
+        for name, bit in TAG_BITS.items()
+    }
+
+# Connections are pooled per thread: close() hands the connection back to
+# the calling thread's pool instead of closing it, so callers keep the
+# get_conn()/close() pattern while statements stay prepared in sqlite3's
+# per-connection cache and the pragmas below run once per connection.
+# Nested get_conn() calls in one thread still get separate connections, and
+# an uncommitted transaction is rolled back on close() as before.
+MMAP_SIZE = int(os.getenv("DB_MMAP_MB") or 256) * 1024 * 1024
+CACHE_SIZE_KB = int(os.getenv("DB_CACHE_MB") or 64) * 1024
+STATEMENT_CACHE = 256
+POOL_SIZE = 2
+
+_pool = threading.local()
+
+class PooledConnection(sqlite3.Connection):
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        idle = _idle_connections()
+        if (
+            self.pid == os.getpid()
+            and self.db_path == DB_PATH
+            and self.thread == threading.get_ident()
+            and len(idle) < POOL_SIZE
+            and self not in idle
+        ):
+            idle.append(self)
+        else:
+            super().close()
+
+def _idle_connections() -> list:
+    idle = getattr(_pool, "idle", None)
+    if idle is None or getattr(_pool, "pid", None) != os.getpid():
+        # A forked child must not share its parent's connections.
+        idle = _pool.idle = []
+        _pool.pid = os.getpid()
+    return idle
+
+def _connect() -> PooledConnection:
+    conn = sqlite3.connect(DB_PATH, factory=PooledConnection, cached_statements=STATEMENT_CACHE, timeout=30)
+    conn.pid = os.getpid()
+    conn.db_path = DB_PATH
+    conn.thread = threading.get_ident()
     conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE};")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB};")
+    conn.execute("PRAGMA temp_store=MEMORY;")
     return conn
 
+def get_conn() -> sqlite3.Connection:
+    idle = _idle_connections()
+    while idle:
+        conn = idle.pop()
+        if conn.db_path == DB_PATH:
+            return conn
+        sqlite3.Connection.close(conn)
+    return _connect()
+
+def get_count(conn, name: str = "live") -> int:
+    # Maintained by triggers on images: "live" and "deleted" rows.
+    row = conn.execute("SELECT value FROM counts WHERE name=?", (name,)).fetchone()
+    return row[0] if row else 0
+
+def get_generation(conn) -> int:
+    row = conn.execute("SELECT value FROM meta WHERE key='generation'").fetchone()
+    return row[0] if row else 0
+
+def bump_generation(conn):
+    # Bumped in the same transaction as any change to indexed rows, so
+    # caches keyed by it are invalidated across processes too.
+    conn.execute(
+        "INSERT INTO meta(key, value) VALUES('generation', 1) "
+        "ON CONFLICT(key) DO UPDATE SET value=value+1"
+    )
+
 def init_db():
     conn = get_conn()
     conn.execute("""
@@ -22,17 +137,171 @@ def init_db():
     """)
     conn.execute("CREATE INDEX IF NOT EXISTS idx_images_deleted ON images(deleted);")
     cols = {row[1] for row in conn.execute("PRAGMA table_info(images);").fetchall()}
-    new_cols = [
-        "has_people",
-        "has_faces",
-        "has_text",
-        "is_indoor",
-        "is_outdoor",
-        "is_document",
-        "is_screenshot",
-    ]
-    for col in new_cols:
-        if col not in cols:
-            conn.execute(f"ALTER TABLE images ADD COLUMN {col} INTEGER;")
+    if "tag_bits" not in cols:
+        conn.execute("ALTER TABLE images ADD COLUMN tag_bits INTEGER NOT NULL DEFAULT 0;")
+        conn.execute("ALTER TABLE images ADD COLUMN tag_known INTEGER NOT NULL DEFAULT 0;")
+        legacy = [c for c in LEGACY_TAG_COLUMNS if c in cols]
+        if legacy:
+            bits_expr = " | ".join(f"(CASE WHEN {c}=1 THEN {TAG_BITS[c]} ELSE 0 END)" for c in legacy)
+            known_expr = " | ".join(f"(CASE WHEN {c} IS NOT NULL THEN {TAG_BITS[c]} ELSE 0 END)" for c in legacy)
+            conn.execute(f"UPDATE images SET tag_bits = {bits_expr}, tag_known = {known_expr};")
+    if "size" not in cols:
+        conn.execute("ALTER TABLE images ADD COLUMN size INTEGER;")
+    if "content_hash" not in cols:
+        conn.execute("ALTER TABLE images ADD COLUMN content_hash TEXT;")
+    if "phash" not in cols:
+        # Perceptual hash (utils.images.dhash) for near-duplicate detection.
+        conn.execute("ALTER TABLE images ADD COLUMN phash INTEGER;")
+    if "modified" not in cols:
+        conn.execute("ALTER TABLE images ADD COLUMN modified INTEGER NOT NULL DEFAULT 0;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_content_hash ON images(content_hash);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_modified ON images(modified);")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS query_embeddings (
+        provider TEXT NOT NULL,
+        query TEXT NOT NULL,
+        embedding BLOB NOT NULL,
+        PRIMARY KEY(provider, query)
+    );
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS content_cache (
+        hash TEXT PRIMARY KEY,
+        caption TEXT,
+        tags TEXT
+    );
+    """)
+    # Offline batch indexing (core.batch): one row per submitted JSONL file
+    # and one per image travelling through the caption and embedding jobs.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS batch_jobs (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        input_path TEXT NOT NULL,
+        remote_id TEXT,
+        status TEXT NOT NULL,
+        created REAL NOT NULL,
+        updated REAL NOT NULL
+    );
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS batch_items (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL,
+        mtime REAL NOT NULL,
+        size INTEGER,
+        content_hash TEXT,
+        caption_job INTEGER,
+        embed_job INTEGER,
+        caption TEXT,
+        tags TEXT,
+        state TEXT NOT NULL
+    );
+    """)
+    if "phash" not in {row[1] for row in conn.execute("PRAGMA table_info(batch_items);")}:
+        conn.execute("ALTER TABLE batch_items ADD COLUMN phash INTEGER;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_items_state ON batch_items(state);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_items_path ON batch_items(path);")
+    # Nearest-neighbour graph (core.neighbours): packed ids and scores per
+    # image, best first, and the lowest score in the list.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS neighbours (
+        id INTEGER PRIMARY KEY,
+        ids BLOB NOT NULL,
+        scores BLOB NOT NULL,
+        floor REAL NOT NULL
+    );
+    """)
+    _init_fts(conn)
+    _init_counts(conn)
+    _init_modified(conn)
     conn.commit()
     conn.close()
+
+def _init_counts(conn):
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='counts'"
+    ).fetchone()
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS counts (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS images_count_ai AFTER INSERT ON images BEGIN
+        UPDATE counts SET value = value + 1
+        WHERE name = CASE WHEN NEW.deleted = 0 THEN 'live' ELSE 'deleted' END;
+    END;
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS images_count_ad AFTER DELETE ON images BEGIN
+        UPDATE counts SET value = value - 1
+        WHERE name = CASE WHEN OLD.deleted = 0 THEN 'live' ELSE 'deleted' END;
+    END;
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS images_count_au AFTER UPDATE OF deleted ON images
+    WHEN (OLD.deleted = 0) IS NOT (NEW.deleted = 0) BEGIN
+        UPDATE counts SET value = value + (CASE WHEN NEW.deleted = 0 THEN 1 ELSE -1 END) WHERE name = 'live';
+        UPDATE counts SET value = value + (CASE WHEN NEW.deleted = 0 THEN -1 ELSE 1 END) WHERE name = 'deleted';
+    END;
+    """)
+    if not exists:
+        conn.execute(
+            "INSERT INTO counts(name, value) "
+            "SELECT 'live', COUNT(*) FROM images WHERE deleted = 0 "
+            "UNION ALL SELECT 'deleted', COUNT(*) FROM images WHERE deleted <> 0"
+        )
+
+def _init_modified(conn):
+    # images.modified is the generation a row last changed in (the one its
+    # writer's bump_generation produces), so other processes can reload just
+    # the rows changed since the generation they last saw. Triggers keep it
+    # current for every writer, including bulk UPDATEs.
+    stamp = """
+        UPDATE images SET modified = (
+            SELECT COALESCE(MAX(value), 0) + 1 FROM meta WHERE key='generation'
+        ) WHERE id = NEW.id;
+    """
+    conn.executescript(f"""
+    CREATE TRIGGER IF NOT EXISTS images_modified_ai AFTER INSERT ON images BEGIN {stamp} END;
+    CREATE TRIGGER IF NOT EXISTS images_modified_au
+    AFTER UPDATE OF path, caption, embedding, tag_bits, tag_known, deleted ON images BEGIN {stamp} END;
+    """)
+
+def _init_fts(conn):
+    # External-content FTS5 index over captions, kept in sync by triggers
+    # on every write to images.caption.
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='images_fts'"
+    ).fetchone()
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS images_fts "
+            "USING fts5(caption, content='images', content_rowid='id');"
+        )
+    except sqlite3.OperationalError:
+        # SQLite built without FTS5: keyword search stays unavailable.
+        return
+    conn.executescript("""
+    CREATE TRIGGER IF NOT EXISTS images_fts_ai AFTER INSERT ON images BEGIN
+        INSERT INTO images_fts(rowid, caption) VALUES (new.id, new.caption);
+    END;
+    CREATE TRIGGER IF NOT EXISTS images_fts_ad AFTER DELETE ON images BEGIN
+        INSERT INTO images_fts(images_fts, rowid, caption) VALUES ('delete', old.id, old.caption);
+    END;
+    CREATE TRIGGER IF NOT EXISTS images_fts_au AFTER UPDATE OF caption ON images BEGIN
+        INSERT INTO images_fts(images_fts, rowid, caption) VALUES ('delete', old.id, old.caption);
+        INSERT INTO images_fts(rowid, caption) VALUES (new.id, new.caption);
+    END;
+    """)
+    if not exists:
+        conn.execute("INSERT INTO images_fts(images_fts) VALUES ('rebuild');")
@@ -1,8 +1,15 @@
-from core.db import get_conn
+from core.db import bump_generation, get_conn
+from core.emb_index import notify_deleted
 
 def mark_deleted(paths):
     conn = get_conn()
+    ids = []
     for p in paths:
-        conn.execute("UPDATE images SET deleted=1 WHERE path=?", (p,))
+        row = conn.execute("UPDATE images SET deleted=1 WHERE path=? RETURNING id", (p,)).fetchone()
+        if row:
+            ids.append(row[0])
+    if ids:
+        bump_generation(conn)
     conn.commit()
     conn.close()
+    notify_deleted(ids)
@@ -0,0 +1,157 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from core.db import get_conn, init_db
+from core.scanner import prefix_bounds
+from utils.images import dhash
+
+# Near-duplicate clusters by Hamming distance between perceptual hashes.
+# Multi-index hashing: the 64 hash bits are split into max_distance + 1
+# chunks, and by the pigeonhole principle two hashes within max_distance bits
+# agree exactly on at least one chunk. Candidate pairs are only formed among
+# rows with equal chunk values, checked on the full hash, and the pairs that
+# survive are joined into clusters. Larger distances mean narrower chunks and
+# many more candidates, so keep it small: re-saved copies are usually 0-2
+# bits apart, burst shots a few more.
+MAX_DISTANCE = int(os.getenv("DUPLICATE_MAX_DISTANCE") or 4)
+HASH_BITS = 64
+BACKFILL_WORKERS = int(os.getenv("INDEX_LOAD_WORKERS") or min(8, os.cpu_count() or 1))
+BACKFILL_BATCH = 500
+
+def _chunks(max_distance: int) -> List[Tuple[int, int]]:
+    # (shift, mask) of max_distance + 1 near-equal slices of the hash.
+    n = max_distance + 1
+    bounds = [HASH_BITS * i // n for i in range(n + 1)]
+    return [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+
+def _equal_pairs(keys: np.ndarray) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    # Every pair of positions with the same key, in batches. After sorting,
+    # equal keys are contiguous, so each round compares neighbours one step
+    # further apart and drops positions whose run has ended: the total work
+    # is proportional to the number of pairs, not n².
+    order = np.argsort(keys, kind="stable")
+    ordered = keys[order]
+    idx = np.arange(len(keys))
+    step = 1
+    while True:
+        idx = idx[idx + step < len(keys)]
+        idx = idx[ordered[idx] == ordered[idx + step]]
+        if not idx.size:
+            return
+        yield order[idx], order[idx + step]
+        step += 1
+
+def near_duplicate_pairs(hashes: np.ndarray, max_distance: int = MAX_DISTANCE) -> np.ndarray:
+    # Returns an (m, 2) array of row positions, each pair listed once.
+    h = np.asarray(hashes, dtype=np.int64).view(np.uint64)
+    found = []
+    for shift, mask in _chunks(max_distance):
+        keys = (h >> np.uint64(shift)) & np.uint64(mask)
+        for a, b in _equal_pairs(keys):
+            close = np.bitwise_count(h[a] ^ h[b]) <= max_distance
+            found.append(np.stack([np.minimum(a, b)[close], np.maximum(a, b)[close]], axis=1))
+    if not found:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.concatenate(found)
+    # The same pair turns up once per chunk it agrees on.
+    keys = np.unique(pairs[:, 0] * len(h) + pairs[:, 1])
+    return np.stack([keys // len(h), keys % len(h)], axis=1)
+
+def _clusters(pairs: np.ndarray) -> List[List[int]]:
+    parent: Dict[int, int] = {}
+
+    def find(x):
+        root = x
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while x != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for a, b in pairs.tolist():
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    groups: Dict[int, List[int]] = {}
+    for x in parent:
+        groups.setdefault(find(x), []).append(x)
+    for root in groups:
+        groups[root].append(root)
+    return list(groups.values())
+
+def find_duplicates(max_distance: int = MAX_DISTANCE, folder: Optional[str] = None) -> List[List[Dict]]:
+    # Clusters of near-identical images, largest first. Images indexed
+    # before hashes existed are skipped until backfill_hashes() runs.
+    where, params = "deleted=0 AND phash IS NOT NULL", ()
+    if folder:
+        where += " AND path >= ? AND path < ?"
+        params = prefix_bounds(folder)
+    conn = get_conn()
+    try:
+        rows = conn.execute(f"SELECT id, path, phash FROM images WHERE {where}", params).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return []
+    hashes = np.fromiter((r[2] for r in rows), dtype=np.int64, count=len(rows))
+    clusters = [
+        sorted(({"id": rows[i][0], "path": rows[i][1]} for i in members), key=lambda r: r["path"])
+        for members in _clusters(near_duplicate_pairs(hashes, max_distance))
+    ]
+    clusters.sort(key=len, reverse=True)
+    return clusters
+
+def _file_hash(path: str) -> Optional[int]:
+    try:
+        with Image.open(path) as img:
+            img.draft("RGB", (256, 256))
+            return dhash(ImageOps.exif_transpose(img))
+    except Exception as e:
+        print(f"[WARN] Cannot hash {path}: {e}")
+        return None
+
+def backfill_hashes(folder: Optional[str] = None, workers: Optional[int] = None) -> int:
+    # Hashes images indexed before the phash column existed.
+    where, params = "deleted=0 AND phash IS NULL", ()
+    if folder:
+        where += " AND path >= ? AND path < ?"
+        params = prefix_bounds(folder)
+    conn = get_conn()
+    done = 0
+    try:
+        rows = conn.execute(f"SELECT id, path FROM images WHERE {where}", params).fetchall()
+        with ThreadPoolExecutor(max_workers=workers or BACKFILL_WORKERS, thread_name_prefix="dupes-hash") as pool:
+            for start in range(0, len(rows), BACKFILL_BATCH):
+                batch = rows[start:start + BACKFILL_BATCH]
+                hashes = pool.map(_file_hash, [path for (_id, path) in batch])
+                updates = [(h, img_id) for (img_id, _p), h in zip(batch, hashes) if h is not None]
+                conn.executemany("UPDATE images SET phash=? WHERE id=?", updates)
+                conn.commit()
+                done += len(updates)
+    finally:
+        conn.close()
+    return done
+
+def main():
+    parser = argparse.ArgumentParser(description="List clusters of near-duplicate images.")
+    parser.add_argument("--folder", default=None, help="Only look at images under this folder.")
+    parser.add_argument("--distance", type=int, default=MAX_DISTANCE, help="Max differing hash bits (0-10).")
+    parser.add_argument("--backfill", action="store_true", help="First hash images indexed without one.")
+    args = parser.parse_args()
+    init_db()
+    if args.backfill:
+        print(f"[INFO] Hashed {backfill_hashes(args.folder)} images")
+    clusters = find_duplicates(args.distance, args.folder)
+    for cluster in clusters:
+        for row in cluster:
+            print(row["path"])
+        print()
+    print(f"{len(clusters)} clusters, {sum(len(c) for c in clusters)} images")
+
+if __name__ == "__main__":
+    main()
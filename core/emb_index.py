@@ -0,0 +1,313 @@
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from core.ann import notify_ann
+from core.db import get_conn, get_generation, pack_tags
+from core.emb_store import EmbeddingStore, get_store
+from core.quant import blob_format, decode as decode_embedding
+
+# Quantized scans rerank this many candidates per requested result.
+RERANK_FACTOR = 4
+RERANK_MIN = 100
+RECONCILE_BATCH = 500
+
+# Vectors live in the memory-mapped sidecar store; this index only keeps the
+# per-row metadata needed to filter and present results. Rows are addressed
+# by images.id in both, so incremental updates are O(1).
+
+class EmbeddingIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self.loaded = False
+        self.size = 0
+        self.known = np.zeros(0, dtype=bool)
+        self.tag_bits = np.zeros(0, dtype=np.uint16)
+        self.tag_known = np.zeros(0, dtype=np.uint16)
+        self.paths = np.empty(0, dtype=object)
+        self.captions = np.empty(0, dtype=object)
+        self.ids_by_path: Dict[str, int] = {}
+        self.generation = 0
+
+    def ensure_loaded(self):
+        with self._lock:
+            if not self.loaded:
+                self._load()
+            else:
+                self._sync()
+
+    def reset(self):
+        with self._lock:
+            self._clear()
+
+    def _load(self):
+        store = get_store()
+        conn = get_conn()
+        try:
+            db_live = conn.execute(
+                "SELECT COUNT(*) FROM images WHERE deleted=0 AND embedding IS NOT NULL"
+            ).fetchone()[0]
+            if db_live != int(store.live_mask().sum()):
+                _reconcile_store(store, conn)
+            self.generation = get_generation(conn)
+            self._load_metadata(conn)
+        finally:
+            conn.close()
+        self.loaded = True
+
+    def _sync(self):
+        # Picks up rows another process added, moved, recaptioned, retagged,
+        # deleted or restored since the generation this index last saw. The
+        # generation is read first: anything committed after it is stamped
+        # with a later one and caught by the next sync.
+        store = get_store()
+        store.refresh()
+        conn = get_conn()
+        try:
+            generation = get_generation(conn)
+            if generation != self.generation:
+                rows = conn.execute(
+                    "SELECT id, path, caption, tag_bits, tag_known, deleted, embedding IS NOT NULL "
+                    "FROM images WHERE modified>?",
+                    (self.generation,),
+                )
+                for (img_id, path, caption, bits, known, deleted, has_embedding) in rows:
+                    if deleted or not has_embedding:
+                        self.remove_ids([img_id])
+                    else:
+                        self._set_row(img_id, path, caption, bits, known)
+                self.generation = generation
+        finally:
+            conn.close()
+
+    def _load_metadata(self, conn):
+        rows = conn.execute(
+            "SELECT id, path, caption, tag_bits, tag_known FROM images "
+            "WHERE deleted=0 AND embedding IS NOT NULL"
+        )
+        for (img_id, path, caption, bits, known) in rows:
+            self._set_row(img_id, path, caption, bits, known)
+
+    def _grow(self, min_size: int):
+        capacity = len(self.known)
+        if min_size <= capacity:
+            return
+        new_capacity = max(min_size, int(capacity * 1.5) + 1024)
+
+        known = np.zeros(new_capacity, dtype=bool)
+        known[:capacity] = self.known
+        tag_bits = np.zeros(new_capacity, dtype=np.uint16)
+        tag_bits[:capacity] = self.tag_bits
+        tag_known = np.zeros(new_capacity, dtype=np.uint16)
+        tag_known[:capacity] = self.tag_known
+        paths = np.empty(new_capacity, dtype=object)
+        paths[:capacity] = self.paths
+        captions = np.empty(new_capacity, dtype=object)
+        captions[:capacity] = self.captions
+
+        self.known, self.tag_bits, self.tag_known = known, tag_bits, tag_known
+        self.paths, self.captions = paths, captions
+
+    def _set_row(self, img_id: int, path: str, caption: str, bits: int, known: int):
+        self._grow(img_id + 1)
+        if self.known[img_id] and self.paths[img_id] != path:
+            self.ids_by_path.pop(self.paths[img_id], None)
+        self.known[img_id] = True
+        self.tag_bits[img_id] = bits
+        self.tag_known[img_id] = known
+        self.paths[img_id] = path
+        self.captions[img_id] = caption
+        self.ids_by_path[path] = img_id
+        self.size = max(self.size, img_id + 1)
+
+    def upsert(self, img_id: int, path: str, caption: str, tags: Dict):
+        with self._lock:
+            if self.loaded:
+                self._set_row(img_id, path, caption, *pack_tags(tags))
+
+    def update_tags(self, path: str, tags: Dict):
+        with self._lock:
+            img_id = self.ids_by_path.get(path)
+            if img_id is not None:
+                self.tag_bits[img_id], self.tag_known[img_id] = pack_tags(tags)
+
+    def rename(self, img_id: int, path: str):
+        with self._lock:
+            if img_id < len(self.known) and self.known[img_id]:
+                self.ids_by_path.pop(self.paths[img_id], None)
+                self.paths[img_id] = path
+                self.ids_by_path[path] = img_id
+
+    def set_tag_bits(self, ids: np.ndarray, bits: np.ndarray, known: np.ndarray):
+        with self._lock:
+            if not self.loaded:
+                return
+            ids = np.asarray(ids, dtype=np.int64)
+            ok = ids < self.size
+            self.tag_bits[ids[ok]] = np.asarray(bits)[ok]
+            self.tag_known[ids[ok]] = np.asarray(known)[ok]
+
+    def remove_ids(self, ids: Iterable[int]):
+        with self._lock:
+            for img_id in ids:
+                if img_id < len(self.known) and self.known[img_id]:
+                    self.known[img_id] = False
+                    self.ids_by_path.pop(self.paths[img_id], None)
+
+    def allowed(self, ids: np.ndarray, mask_fn=None) -> np.ndarray:
+        store = get_store()
+        with self._lock:
+            n = min(self.size, store.count)
+            ok = ids < n
+            in_range = ids[ok]
+            keep = self.known[in_range] & store.live_mask()[in_range]
+            if mask_fn is not None:
+                mask = mask_fn(self.tag_bits[in_range], self.tag_known[in_range])
+                if mask is not None:
+                    keep &= mask
+            ok[ok] = keep
+        return ok
+
+    def top_k(
+        self,
+        q: np.ndarray,
+        k: int,
+        mask_fn: Optional[Callable[[np.ndarray, np.ndarray], np.ndarray]] = None,
+        candidates: Optional[np.ndarray] = None,
+        quantized: bool = False,
+        coarse: int = 0,
+    ) -> List[Tuple[float, int]]:
+        store = get_store()
+        with self._lock:
+            n = min(self.size, store.count)
+            if n == 0 or k <= 0:
+                return []
+            keep = self.known[:n] & store.live_mask()[:n]
+            mask = mask_fn(self.tag_bits[:n], self.tag_known[:n]) if mask_fn is not None else None
+            if mask is not None:
+                keep &= mask
+
+        q = np.asarray(q, dtype=np.float32)
+        if q.size != store.dim:
+            raise ValueError(f"Query dimension {q.size} does not match index dimension {store.dim}")
+        q_norm = float(np.linalg.norm(q))
+        if q_norm == 0:
+            q_norm = 1.0
+
+        q = q / q_norm
+
+        if candidates is not None:
+            # Exact rerank of an approximate candidate set.
+            ids = candidates[candidates < n]
+            ids = ids[keep[ids]]
+            scores = store.vectors(ids) @ q
+        elif (coarse > 0 and store.prefix_dim) or quantized:
+            # Shortlist on the int8 rows, then rerank at full precision. With
+            # `coarse` (shortlist size per result) only their prefix is read.
+            ids = np.flatnonzero(keep)
+            if coarse > 0 and store.prefix_dim:
+                approx = store.prefix_scores(q)[:n][ids]
+                depth = max(k * coarse, RERANK_MIN)
+            else:
+                approx = store.quantized_scores(q)[:n][ids]
+                depth = max(k * RERANK_FACTOR, RERANK_MIN)
+            if depth < len(ids):
+                ids = ids[np.argpartition(-approx, depth - 1)[:depth]]
+            scores = store.vectors(ids) @ q
+        else:
+            ids = np.flatnonzero(keep)
+            scores = store.scores(q)[:n][ids]
+
+        k = min(k, len(ids))
+        if k == 0:
+            return []
+        if k < len(ids):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(ids))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(float(scores[i]), int(ids[i])) for i in top]
+
+def _reconcile_store(store: EmbeddingStore, conn):
+    # Brings the store in line with the committed rows: fills in rows it
+    # lacks from the embedding BLOBs (first use, a deleted store, or a writer
+    # that has committed but not yet published) and tombstones rows deleted
+    # since. Writers publish only after committing, and the store is read
+    # before the database, so a live store row the database doesn't list
+    # really is gone. Nothing else is rewritten.
+    store.refresh()
+    store_live = np.flatnonzero(store.live_mask())
+    first = conn.execute(
+        "SELECT embedding FROM images WHERE deleted=0 AND embedding IS NOT NULL LIMIT 1"
+    ).fetchone()
+    db_live = np.array(
+        [r[0] for r in conn.execute("SELECT id FROM images WHERE deleted=0 AND embedding IS NOT NULL")],
+        dtype=np.int64,
+    )
+    if first is not None:
+        dim = len(decode_embedding(first[0]))
+        if store.dim != dim:
+            store.create(dim)
+            store_live = np.flatnonzero(store.live_mask())
+
+    stale = np.setdiff1d(store_live, db_live)
+    for start in range(0, len(stale), RECONCILE_BATCH):
+        ids = [int(i) for i in stale[start:start + RECONCILE_BATCH]]
+        marks = ",".join("?" * len(ids))
+        # Skip rows restored since the list above was read.
+        back = {r[0] for r in conn.execute(
+            f"SELECT id FROM images WHERE id IN ({marks}) AND deleted=0 AND embedding IS NOT NULL", ids
+        )}
+        for img_id in ids:
+            if img_id not in back:
+                store.delete(img_id)
+
+    missing = np.setdiff1d(db_live, store_live)
+    if len(missing) and blob_format(first[0]) != "float32":
+        # The store's float32 rows can only be as precise as their source.
+        fmt = blob_format(first[0])
+        print(f"[INFO] Filling {len(missing)} embedding store rows from {fmt} embeddings; reranking them uses {fmt} precision")
+    for start in range(0, len(missing), RECONCILE_BATCH):
+        # Rows their writer published meanwhile keep its vectors.
+        ids = missing[start:start + RECONCILE_BATCH]
+        live = store.live_mask()
+        ids = [int(i) for i in ids if i >= len(live) or not live[i]]
+        if not ids:
+            continue
+        marks = ",".join("?" * len(ids))
+        for img_id, emb_blob in conn.execute(
+            f"SELECT id, embedding FROM images WHERE id IN ({marks}) AND deleted=0 AND embedding IS NOT NULL", ids
+        ):
+            store.put(img_id, decode_embedding(emb_blob))
+    store.flush()
+
+_INDEX = EmbeddingIndex()
+
+def get_index() -> EmbeddingIndex:
+    _INDEX.ensure_loaded()
+    return _INDEX
+
+def notify_upsert(img_id: int, path: str, caption: str, vec: np.ndarray, tags: Dict):
+    get_store().put(img_id, vec)
+    notify_ann(img_id, vec)
+    _INDEX.upsert(img_id, path, caption, tags)
+
+def notify_tags(path: str, tags: Dict):
+    _INDEX.update_tags(path, tags)
+
+def notify_tag_bits(ids, bits, known):
+    _INDEX.set_tag_bits(ids, bits, known)
+
+def notify_moved(img_id: int, path: str):
+    _INDEX.rename(img_id, path)
+
+def notify_deleted(ids: Iterable[int]):
+    ids = list(ids)
+    store = get_store()
+    for img_id in ids:
+        store.delete(img_id)
+    _INDEX.remove_ids(ids)
@@ -0,0 +1,335 @@
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+from core import db
+from core.quant import quantize_int8
+
+# Sidecar store in gallery.emb/ next to gallery.db. Embeddings are split into
+# fixed-size segment files; segment S holds images.id in
+# [S * SEGMENT_ROWS, (S + 1) * SEGMENT_ROWS). Each segment is
+#   64-byte header (magic, version, dim, segment number, rows used)
+#   tombstone bitmap, one bit per row, set while the row is absent/deleted
+#   SEGMENT_ROWS fixed-stride float32 rows, normalized
+#   the same rows quantized to int8, stored as two column blocks: the first
+#   PREFIX_DIM values of every row, then the rest of every row
+#   one float32 scale per row, then one float32 per row: 1 / norm of the
+#   int8 row's first PREFIX_DIM values
+# Approximate passes only read the int8 rows: all of each row (a quarter of
+# the float32 bytes) or just the contiguous prefix block (useful for
+# Matryoshka-style embeddings such as text-embedding-3). The float32 rows
+# are only touched to rerank the shortlist. Segments are created at full
+# size and never resized, so other processes can keep them mapped (Windows
+# refuses to resize mapped files) and see new rows through the shared page
+# cache. Growth only ever adds segments.
+MAGIC = b"GEMB"
+VERSION = 4
+UPGRADE_FROM = 3
+HEADER = struct.Struct("<4sIIIQ")
+HEADER_SIZE = 64
+SEGMENT_ROWS = 1 << 14
+TOMB_SIZE = SEGMENT_ROWS // 8
+SCAN_BLOCK_ROWS = 2048
+PREFIX_DIM = 256
+
+def prefix_dim(dim: int) -> int:
+    # Short embeddings gain nothing from a separate prefix pass.
+    return PREFIX_DIM if dim >= 2 * PREFIX_DIM else 0
+
+def _segment_size(dim: int) -> int:
+    return HEADER_SIZE + TOMB_SIZE + SEGMENT_ROWS * (dim * 5 + 8)
+
+def _inverse_norm(head: np.ndarray) -> float:
+    norm = float(np.linalg.norm(head))
+    return 1.0 / norm if norm > 0 else 0.0
+
+def _write_rows(seg: "_Segment", start: int, rows: np.ndarray):
+    # rows: normalized float32, one per row from `start`, written to every
+    # copy the segment keeps.
+    stop = start + len(rows)
+    pdim = seg.qhead.shape[1]
+    seg.rows[start:stop] = rows
+    q, scale = quantize_int8(rows)
+    seg.qhead[start:stop] = q[:, :pdim]
+    seg.qtail[start:stop] = q[:, pdim:]
+    seg.scales[start:stop] = scale
+    norms = np.linalg.norm(q[:, :pdim].astype(np.float32), axis=1)
+    seg.prefix_scales[start:stop] = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+
+def store_dir(db_path: Optional[Path] = None) -> Path:
+    return Path(db_path or db.DB_PATH).with_suffix(".emb")
+
+class _Segment:
+    def __init__(self, path: Path, number: int, dim: int):
+        self.number = number
+        self.base = number * SEGMENT_ROWS
+        with path.open("r+b") as f:
+            self._map = mmap.mmap(f.fileno(), 0)
+        self.tomb = np.frombuffer(self._map, dtype=np.uint8, count=TOMB_SIZE, offset=HEADER_SIZE)
+        offset = HEADER_SIZE + TOMB_SIZE
+        self.rows = np.frombuffer(
+            self._map, dtype=np.float32, count=SEGMENT_ROWS * dim, offset=offset
+        ).reshape(SEGMENT_ROWS, dim)
+        offset += SEGMENT_ROWS * dim * 4
+        pdim = prefix_dim(dim)
+        self.qhead = np.frombuffer(
+            self._map, dtype=np.int8, count=SEGMENT_ROWS * pdim, offset=offset
+        ).reshape(SEGMENT_ROWS, pdim)
+        offset += SEGMENT_ROWS * pdim
+        self.qtail = np.frombuffer(
+            self._map, dtype=np.int8, count=SEGMENT_ROWS * (dim - pdim), offset=offset
+        ).reshape(SEGMENT_ROWS, dim - pdim)
+        offset += SEGMENT_ROWS * (dim - pdim)
+        self.scales = np.frombuffer(self._map, dtype=np.float32, count=SEGMENT_ROWS, offset=offset)
+        offset += SEGMENT_ROWS * 4
+        self.prefix_scales = np.frombuffer(self._map, dtype=np.float32, count=SEGMENT_ROWS, offset=offset)
+
+    @property
+    def used(self) -> int:
+        return HEADER.unpack_from(self._map, 0)[4]
+
+    def set_used(self, used: int):
+        magic, version, dim, number, _ = HEADER.unpack_from(self._map, 0)
+        HEADER.pack_into(self._map, 0, magic, version, dim, number, used)
+
+    def flush(self):
+        self._map.flush()
+
+def _segment_path(root: Path, number: int) -> Path:
+    return root / f"{number:05d}.seg"
+
+def _read_header(path: Path):
+    with path.open("rb") as f:
+        return HEADER.unpack(f.read(HEADER.size))
+
+class EmbeddingStore:
+    def __init__(self, db_path: Optional[Path] = None):
+        self.root = store_dir(db_path)
+        self._lock = threading.RLock()
+        self.dim = 0
+        self._segments: List[Optional[_Segment]] = []
+
+    def open(self) -> bool:
+        with self._lock:
+            self.dim = 0
+            self._segments = []
+            if not self.root.is_dir():
+                return False
+            for path in sorted(self.root.glob("*.seg")):
+                magic, version, dim, number, used = _read_header(path)
+                if magic != MAGIC or version not in (UPGRADE_FROM, VERSION):
+                    continue
+                if self.dim and dim != self.dim:
+                    raise ValueError(f"Embedding store {self.root} mixes dimensions {self.dim} and {dim}")
+                self.dim = dim
+                if version == UPGRADE_FROM:
+                    self._upgrade(number, used)
+                else:
+                    self._attach(path, number)
+            return self.dim > 0
+
+    def _upgrade(self, number: int, used: int):
+        # Version 3 segments have the same header, tombstones and float32
+        # rows. Converting them keeps those rows: gallery.db may only hold
+        # lossy copies by now (core.quant), so rebuilding from it would give
+        # up full precision for good.
+        with _segment_path(self.root, number).open("rb") as f:
+            f.seek(HEADER_SIZE)
+            tomb = np.frombuffer(f.read(TOMB_SIZE), dtype=np.uint8)
+            rows = np.fromfile(f, dtype=np.float32, count=used * self.dim).reshape(used, self.dim)
+        seg = self._new_segment(number, replace=True)
+        for start in range(0, used, SCAN_BLOCK_ROWS):
+            _write_rows(seg, start, rows[start:start + SCAN_BLOCK_ROWS])
+        seg.tomb[:] = tomb
+        seg.set_used(used)
+        seg.flush()
+
+    def create(self, dim: int):
+        # Switches the store to `dim`-sized embeddings. Only segments of
+        # another dimension or an unknown format are removed: ones of this
+        # dimension may have just been written by another process.
+        with self._lock:
+            self.root.mkdir(parents=True, exist_ok=True)
+            for path in self.root.glob("*.seg"):
+                magic, version, seg_dim, _number, _used = _read_header(path)
+                if magic != MAGIC or version not in (UPGRADE_FROM, VERSION) or seg_dim != dim:
+                    path.unlink()
+            self.open()
+            self.dim = dim
+
+    def _attach(self, path: Path, number: int):
+        while len(self._segments) <= number:
+            self._segments.append(None)
+        self._segments[number] = _Segment(path, number, self.dim)
+
+    def _new_segment(self, number: int, replace: bool = False) -> _Segment:
+        # Unless replacing, a segment another process created first wins:
+        # linking fails instead of overwriting it.
+        path = _segment_path(self.root, number)
+        tmp = path.with_suffix(f".{os.getpid()}-{threading.get_ident()}.tmp")
+        with tmp.open("wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.dim, number, 0).ljust(HEADER_SIZE, b"\0"))
+            f.write(b"\xff" * TOMB_SIZE)
+            f.truncate(_segment_size(self.dim))
+        if replace:
+            tmp.replace(path)
+        else:
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                pass
+            finally:
+                tmp.unlink()
+        self._attach(path, number)
+        return self._segments[number]
+
+    def _segment_for(self, img_id: int, create: bool) -> Optional[_Segment]:
+        number = img_id // SEGMENT_ROWS
+        seg = self._segments[number] if number < len(self._segments) else None
+        if seg is None:
+            path = _segment_path(self.root, number)
+            if path.exists():
+                self._attach(path, number)
+                seg = self._segments[number]
+            elif create:
+                seg = self._new_segment(number)
+        return seg
+
+    def refresh(self):
+        with self._lock:
+            if self.dim == 0:
+                self.open()
+                return
+            for path in self.root.glob("*.seg"):
+                number = int(path.stem)
+                if number >= len(self._segments) or self._segments[number] is None:
+                    self._attach(path, number)
+
+    @property
+    def prefix_dim(self) -> int:
+        return prefix_dim(self.dim)
+
+    @property
+    def count(self) -> int:
+        for seg in reversed(self._segments):
+            if seg is not None and seg.used:
+                return seg.base + seg.used
+        return 0
+
+    def put(self, img_id: int, vec: np.ndarray):
+        vec = np.asarray(vec, dtype=np.float32)
+        with self._lock:
+            if self.dim == 0 and not self.open():
+                # Still empty on disk, not just when this process opened it.
+                self.create(vec.size)
+            if vec.size != self.dim:
+                raise ValueError(f"Embedding dimension {vec.size} does not match store dimension {self.dim}")
+            seg = self._segment_for(img_id, create=True)
+            row = img_id - seg.base
+            _write_rows(seg, row, (vec * _inverse_norm(vec))[None, :])
+            seg.tomb[row >> 3] &= ~np.uint8(1 << (row & 7))
+            if row >= seg.used:
+                seg.set_used(row + 1)
+
+    def delete(self, img_id: int):
+        with self._lock:
+            if self.dim == 0:
+                return
+            seg = self._segment_for(img_id, create=False)
+            if seg is not None:
+                row = img_id - seg.base
+                seg.tomb[row >> 3] |= np.uint8(1 << (row & 7))
+
+    def scores(self, q: np.ndarray) -> np.ndarray:
+        # Scored segment by segment straight from the mapping; nothing is
+        # copied except the resulting score vector.
+        with self._lock:
+            n = self.count
+            segments = [s for s in self._segments if s is not None and s.base < n]
+        out = np.zeros(n, dtype=np.float32)
+        for seg in segments:
+            used = min(seg.used, n - seg.base)
+            out[seg.base:seg.base + used] = seg.rows[:used] @ q
+        return out
+
+    def quantized_scores(self, q: np.ndarray) -> np.ndarray:
+        # Approximate scores from the int8 rows, converted a block at a time
+        # so the float32 working set stays small.
+        pdim = self.prefix_dim
+        q = np.asarray(q, dtype=np.float32)
+        with self._lock:
+            n = self.count
+            segments = [s for s in self._segments if s is not None and s.base < n]
+        out = np.zeros(n, dtype=np.float32)
+        for seg in segments:
+            used = min(seg.used, n - seg.base)
+            for start in range(0, used, SCAN_BLOCK_ROWS):
+                stop = min(used, start + SCAN_BLOCK_ROWS)
+                block = seg.qtail[start:stop].astype(np.float32) @ q[pdim:]
+                if pdim:
+                    block += seg.qhead[start:stop].astype(np.float32) @ q[:pdim]
+                out[seg.base + start:seg.base + stop] = block * seg.scales[start:stop]
+        return out
+
+    def prefix_scores(self, q: np.ndarray) -> np.ndarray:
+        # Cosine similarity over the first prefix_dim values of the int8 rows.
+        pdim = self.prefix_dim
+        q = np.asarray(q, dtype=np.float32)[:pdim]
+        q = q * _inverse_norm(q)
+        with self._lock:
+            n = self.count
+            segments = [s for s in self._segments if s is not None and s.base < n]
+        out = np.zeros(n, dtype=np.float32)
+        for seg in segments:
+            used = min(seg.used, n - seg.base)
+            for start in range(0, used, SCAN_BLOCK_ROWS):
+                stop = min(used, start + SCAN_BLOCK_ROWS)
+                block = seg.qhead[start:stop].astype(np.float32) @ q
+                out[seg.base + start:seg.base + stop] = block * seg.prefix_scales[start:stop]
+        return out
+
+    def vectors(self, ids: np.ndarray) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        out = np.zeros((len(ids), self.dim), dtype=np.float32)
+        numbers = ids // SEGMENT_ROWS
+        with self._lock:
+            for number in np.unique(numbers):
+                seg = self._segment_for(int(number) * SEGMENT_ROWS, create=False)
+                if seg is not None:
+                    sel = numbers == number
+                    out[sel] = seg.rows[ids[sel] - seg.base]
+        return out
+
+    def live_mask(self) -> np.ndarray:
+        with self._lock:
+            n = self.count
+            mask = np.zeros(n, dtype=bool)
+            for seg in self._segments:
+                if seg is None or seg.base >= n:
+                    continue
+                bits = np.unpackbits(seg.tomb, bitorder="little")
+                used = min(SEGMENT_ROWS, n - seg.base)
+                mask[seg.base:seg.base + used] = bits[:used] == 0
+        return mask
+
+    def flush(self):
+        with self._lock:
+            for seg in self._segments:
+                if seg is not None:
+                    seg.flush()
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+def get_store() -> EmbeddingStore:
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is None or _STORE.root != store_dir():
+            _STORE = EmbeddingStore()
+            _STORE.open()
+        return _STORE
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+
+from core.db import get_conn
+from utils.metrics import METRICS
+from utils.thumbs import get_preview_cache, get_thumb_cache
+
+# Serves cached thumbnails and previews by image id, so the result grid can
+# reference images by URL instead of inlining them: the browser caches each
+# image once, and app reruns only resend HTML. URLs carry the file's mtime,
+# so an edited photo gets a new URL rather than a stale cached copy.
+#   /thumb/<id>    grid thumbnail
+#   /preview/<id>  screen-sized copy for the full view
+#   /metrics       utils.metrics in the Prometheus text format
+# Only ids of indexed, non-deleted images are served.
+IMAGE_SERVER_HOST = os.getenv("IMAGE_SERVER_HOST") or "127.0.0.1"
+# A fixed port keeps URLs (and the browser's cache of them) valid across
+# restarts; if it is taken, the server falls back to a free one.
+IMAGE_SERVER_PORT = int(os.getenv("IMAGE_SERVER_PORT") or 8765)
+# The address the browser uses, when it differs from the bind address
+# (e.g. IMAGE_SERVER_HOST=0.0.0.0 for viewing the app from another machine).
+IMAGE_SERVER_URL = (os.getenv("IMAGE_SERVER_URL") or "").rstrip("/")
+CACHE_SECONDS = 7 * 24 * 3600
+
+KINDS = {"thumb": get_thumb_cache, "preview": get_preview_cache}
+
+def _lookup(img_id: int) -> Optional[str]:
+    conn = get_conn()
+    try:
+        row = conn.execute("SELECT path FROM images WHERE id=? AND deleted=0", (img_id,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+def etag(kind: str, path: str, st: os.stat_result) -> str:
+    key = f"{kind}|{path}|{st.st_mtime_ns}|{st.st_size}".encode("utf-8")
+    return '"' + hashlib.sha1(key).hexdigest()[:20] + '"'
+
+class _Handler(BaseHTTPRequestHandler):
+    def _route(self) -> Optional[Tuple[str, int]]:
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+        if len(parts) != 2 or parts[0] not in KINDS or not parts[1].isdigit():
+            return None
+        return parts[0], int(parts[1])
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] == "/metrics":
+            data = METRICS.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        route = self._route()
+        if route is None:
+            self.send_error(404)
+            return
+        kind, img_id = route
+        path = _lookup(img_id)
+        try:
+            st = os.stat(path) if path else None
+        except OSError:
+            st = None
+        if st is None:
+            self.send_error(404)
+            return
+
+        tag = etag(kind, path, st)
+        if self.headers.get("If-None-Match") == tag:
+            METRICS.inc("image_requests_total", kind=kind, status=304)
+            self.send_response(304)
+            self.send_header("ETag", tag)
+            self.send_header("Cache-Control", f"private, max-age={CACHE_SECONDS}")
+            self.end_headers()
+            return
+        try:
+            data = KINDS[kind]().get_or_create(path)
+        except Exception as e:
+            print(f"[WARN] Cannot render {kind} for {path}: {e}")
+            self.send_error(500)
+            return
+        METRICS.inc("image_requests_total", kind=kind, status=200)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", tag)
+        self.send_header("Cache-Control", f"private, max-age={CACHE_SECONDS}")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class ImageServer:
+    def __init__(self, host: str = IMAGE_SERVER_HOST, port: int = IMAGE_SERVER_PORT):
+        try:
+            self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        except OSError as e:
+            if not port:
+                raise
+            print(f"[WARN] Image server cannot use port {port} ({e}); using a free port instead")
+            self.httpd = ThreadingHTTPServer((host, 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="image-server", daemon=True)
+        self.thread.start()
+
+    @property
+    def base_url(self) -> str:
+        if IMAGE_SERVER_URL:
+            return IMAGE_SERVER_URL
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, kind: str, img_id: int, version: int) -> str:
+        return f"{self.base_url}/{kind}/{img_id}?v={version}"
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+_SERVER = None
+_SERVER_LOCK = threading.Lock()
+
+def get_image_server() -> ImageServer:
+    # One server per process; Streamlit reruns reuse it.
+    global _SERVER
+    with _SERVER_LOCK:
+        if _SERVER is None:
+            _SERVER = ImageServer()
+        return _SERVER
@@ -1,123 +1,515 @@
+import json
 import os
+import queue
 import sqlite3
-from pathlib import Path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
 from tqdm import tqdm
 
-from core.db import get_conn
+from core.ann import save_ann
+from core.db import bump_generation, get_conn, pack_tags
+from core.db_delete import mark_deleted
+from core.emb_index import notify_moved, notify_upsert, notify_tags
+from core.emb_store import get_store
+from core.neighbours import update_if_built as update_neighbours_if_built
+from core.quant import decode as decode_embedding, encode as encode_embedding
+from core.scanner import SUPPORTED_EXTS, FolderScan, is_changed, prefix_bounds, walk_images
 from providers import get_provider
-from utils.images import load_image_bytes
+from utils.hashing import full_hash, quick_hash
+from utils.images import UPLOAD_STATS, load_image
+from utils.metrics import METRICS
+from utils.thumbs import get_thumb_cache
 
-SUPPORTED_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff"}
+LOAD_WORKERS = int(os.getenv("INDEX_LOAD_WORKERS") or min(8, os.cpu_count() or 1))
+# 0: one caption thread per call the provider can run at once.
+API_WORKERS = int(os.getenv("INDEX_API_WORKERS") or 0)
+WRITE_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE") or 64)
+EMBED_BATCH_SIZE = int(os.getenv("INDEX_EMBED_BATCH_SIZE") or 128)
+WRITE_FLUSH_SECONDS = 2.0
+EMBED_FLUSH_SECONDS = 1.0
+QUEUE_DEPTH_PER_WORKER = 2
+QUEUE_POLL_SECONDS = 0.5
 
 def iter_images(root: str):
-    root_path = Path(root)
-    for p in root_path.rglob("*"):
-        if p.is_file() and p.suffix.lower() in SUPPORTED_EXTS:
-            yield str(p)
+    for path, _st in walk_images(root):
+        yield path
 
-def upsert_image(conn: sqlite3.Connection, path: str, mtime: float, caption: str, embedding_blob: bytes, tags):
-    conn.execute(
+def upsert_image(
+    conn: sqlite3.Connection,
+    path: str,
+    mtime: float,
+    caption: str,
+    embedding_blob: bytes,
+    tags,
+    content_hash: Optional[str] = None,
+    size: Optional[int] = None,
+    phash: Optional[int] = None,
+    vector: Optional[np.ndarray] = None,
+    *,
+    after_commit: List[Callable[[], None]],
+):
+    # Files described from the content cache weren't decoded; they share
+    # the perceptual hash of the identical file already indexed. vector is
+    # the float32 embedding the blob was encoded from; the blob may be a
+    # lossy format, so the store only falls back to decoding it. The shared
+    # embedding store and the in-memory index are only updated once the
+    # caller has committed and run publish(after_commit): other processes
+    # must never see store rows the database doesn't have yet.
+    row = conn.execute(
         """
         INSERT INTO images(
-            path, mtime, caption, embedding, deleted,
-            has_people, has_faces, has_text, is_indoor, is_outdoor, is_document, is_screenshot
+            path, mtime, size, caption, embedding, deleted, content_hash, tag_bits, tag_known, phash
         )
-        VALUES(?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?)
+        VALUES(?, ?, ?, ?, ?, 0, ?, ?, ?, COALESCE(?, (
+            SELECT phash FROM images WHERE content_hash=? AND phash IS NOT NULL LIMIT 1
+        )))
         ON CONFLICT(path) DO UPDATE SET
             mtime=excluded.mtime,
+            size=excluded.size,
             caption=excluded.caption,
             embedding=excluded.embedding,
             deleted=0,
-            has_people=excluded.has_people,
-            has_faces=excluded.has_faces,
-            has_text=excluded.has_text,
-            is_indoor=excluded.is_indoor,
-            is_outdoor=excluded.is_outdoor,
-            is_document=excluded.is_document,
-            is_screenshot=excluded.is_screenshot
+            content_hash=excluded.content_hash,
+            tag_bits=excluded.tag_bits,
+            tag_known=excluded.tag_known,
+            phash=excluded.phash
+        RETURNING id
         """,
         (
             path,
             mtime,
+            size,
             caption,
             embedding_blob,
-            tags.get("has_people"),
-            tags.get("has_faces"),
-            tags.get("has_text"),
-            tags.get("is_indoor"),
-            tags.get("is_outdoor"),
-            tags.get("is_document"),
-            tags.get("is_screenshot"),
+            content_hash,
+            *pack_tags(tags),
+            phash,
+            content_hash,
         ),
-    )
+    ).fetchone()
+    bump_generation(conn)
+    # A new embedding needs a new neighbour list (see core.neighbours).
+    conn.execute("DELETE FROM neighbours WHERE id=?", (row[0],))
+    if content_hash:
+        conn.execute(
+            "INSERT OR REPLACE INTO content_cache(hash, caption, tags) VALUES(?, ?, ?)",
+            (content_hash, caption, json.dumps(tags)),
+        )
+    if vector is None:
+        vector = decode_embedding(bytes(embedding_blob))
+    after_commit.append(partial(notify_upsert, row[0], path, caption, vector, tags))
+    return row[0]
+
+def lookup_cached(conn: sqlite3.Connection, path: str):
+    # Returns (content_hash, cached) where cached is (caption, tags, embedding
+    # blob or None, float32 vector or None) for a byte-identical file that
+    # was already described.
+    key = quick_hash(path)
+    row = conn.execute("SELECT caption, tags FROM content_cache WHERE hash=?", (key,)).fetchone()
+    if row is None:
+        return key, None
+
+    # The quick hash only samples the file. If another file with the same
+    # quick hash is still on disk, compare full hashes before trusting it.
+    others = conn.execute(
+        "SELECT path FROM images WHERE content_hash=? AND path<>? AND deleted=0", (key, path)
+    ).fetchall()
+    twin = next((p for (p,) in others if os.path.exists(p)), None)
+    if twin is not None:
+        full = full_hash(path)
+        if full != full_hash(twin):
+            key = full
+            row = conn.execute("SELECT caption, tags FROM content_cache WHERE hash=?", (key,)).fetchone()
+            if row is None:
+                return key, None
+
+    caption, tags_json = row
+    emb = conn.execute(
+        "SELECT id, embedding FROM images WHERE content_hash=? AND embedding IS NOT NULL LIMIT 1", (key,)
+    ).fetchone()
+    if emb is None:
+        return key, (caption, json.loads(tags_json or "{}"), None, None)
+    return key, (caption, json.loads(tags_json or "{}"), emb[1], _stored_vector(emb[0], emb[1]))
 
-def update_tags(conn: sqlite3.Connection, path: str, mtime: float, tags):
-    conn.execute(
+def _stored_vector(img_id: int, embedding_blob: bytes) -> np.ndarray:
+    # The twin's full-precision store row. Image ids are never reused, so a
+    # non-zero row is this blob's source even if the twin was deleted since.
+    vec = get_store().vectors(np.array([img_id]))[0]
+    return vec if vec.any() else decode_embedding(bytes(embedding_blob))
+
+def update_tags(
+    conn: sqlite3.Connection,
+    path: str,
+    mtime: float,
+    tags,
+    phash: Optional[int] = None,
+    *,
+    after_commit: List[Callable[[], None]],
+):
+    row = conn.execute(
         """
         UPDATE images SET
             mtime=?,
-            has_people=?,
-            has_faces=?,
-            has_text=?,
-            is_indoor=?,
-            is_outdoor=?,
-            is_document=?,
-            is_screenshot=?
+            tag_bits=?,
+            tag_known=?,
+            phash=COALESCE(?, phash)
         WHERE path=?
+        RETURNING id
         """,
         (
             mtime,
-            tags.get("has_people"),
-            tags.get("has_faces"),
-            tags.get("has_text"),
-            tags.get("is_indoor"),
-            tags.get("is_outdoor"),
-            tags.get("is_document"),
-            tags.get("is_screenshot"),
+            *pack_tags(tags),
+            phash,
             path,
         ),
+    ).fetchone()
+    bump_generation(conn)
+    after_commit.append(partial(notify_tags, path, tags))
+    return row[0] if row else None
+
+def publish(after_commit: List[Callable[[], None]]):
+    # Runs the updates upsert_image and update_tags queued, after commit.
+    for update in after_commit:
+        update()
+    after_commit.clear()
+
+def _scan_jobs(scan: FolderScan, rescan_deleted_only: bool, rescan_tags_only: bool):
+    for path, mtime, size, known, changed in scan:
+        if known is not None:
+            deleted = known[2]
+            if rescan_tags_only and deleted == 0:
+                yield path, mtime, size, True
+                continue
+            if rescan_deleted_only and deleted == 0:
+                continue
+            if not rescan_deleted_only and not changed:
+                continue
+        elif rescan_deleted_only or rescan_tags_only:
+            continue
+        yield path, mtime, size, False
+
+def index_folder(
+    folder: str,
+    rescan_deleted_only: bool = False,
+    rescan_tags_only: bool = False,
+    load_workers: Optional[int] = None,
+    api_workers: Optional[int] = None,
+    batch_size: Optional[int] = None,
+    embed_batch_size: Optional[int] = None,
+):
+    scan_conn = get_conn()
+    try:
+        scan = FolderScan(scan_conn, folder, include_unchanged=rescan_tags_only)
+    finally:
+        scan_conn.close()
+
+    _run_pipeline(
+        _scan_jobs(scan, rescan_deleted_only, rescan_tags_only),
+        load_workers, api_workers, batch_size, embed_batch_size,
     )
+    if scan.vanished:
+        mark_deleted(scan.vanished)
+    get_store().flush()
+    save_ann()
+    update_neighbours_if_built()
 
-def index_folder(folder: str, rescan_deleted_only: bool = False, rescan_tags_only: bool = False):
-    provider = get_provider()
+def index_paths(paths: Iterable[str], **pipeline):
+    # Indexes just these files, skipping ones that are gone, unsupported or
+    # unchanged since they were last indexed.
+    jobs = []
     conn = get_conn()
+    try:
+        for path in dict.fromkeys(paths):
+            if os.path.splitext(path)[1].lower() not in SUPPORTED_EXTS:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            known = conn.execute(
+                "SELECT mtime, size, deleted FROM images WHERE path=?", (path,)
+            ).fetchone()
+            if is_changed(known, st):
+                jobs.append((path, st.st_mtime, st.st_size, False))
+    finally:
+        conn.close()
+    if not jobs:
+        return 0
+    _run_pipeline(iter(jobs), **pipeline)
+    get_store().flush()
+    save_ann()
+    update_neighbours_if_built()
+    return len(jobs)
+
+def move_paths(conn: sqlite3.Connection, src: str, dst: str) -> List[Tuple[str, str]]:
+    # Re-points indexed rows at src (a file, or every file under a directory)
+    # to their new location; the caption and embedding stay valid. Returns
+    # the (old, new) pairs that could not be renamed because the destination
+    # is already indexed; those need a delete and a fresh index instead.
+    lo, hi = prefix_bounds(src)
+    rows = conn.execute(
+        "SELECT id, path FROM images WHERE path=? OR (path >= ? AND path < ?)", (src, lo, hi)
+    ).fetchall()
+    conflicts = []
+    moved = []
+    for img_id, old in rows:
+        new = dst + old[len(src):]
+        if conn.execute("SELECT 1 FROM images WHERE path=?", (new,)).fetchone():
+            conflicts.append((old, new))
+            continue
+        conn.execute("UPDATE images SET path=? WHERE id=?", (new, img_id))
+        moved.append((img_id, new))
+    if moved:
+        bump_generation(conn)
+    for img_id, new in moved:
+        notify_moved(img_id, new)
+    return conflicts
+
+def _run_pipeline(
+    jobs: Iterator[Tuple[str, float, int, bool]],
+    load_workers: Optional[int] = None,
+    api_workers: Optional[int] = None,
+    batch_size: Optional[int] = None,
+    embed_batch_size: Optional[int] = None,
+):
+    # Staged pipeline: the scan feeds a decode pool, decoded images go through
+    # a bounded queue to provider workers, captions are embedded in chunks by
+    # one embedding thread, and a single writer thread commits results in
+    # batches. `in_flight` bounds the number of files between scan and commit
+    # so memory stays flat however large the folder is. If a stage thread
+    # dies, or the caller is interrupted, `stop` makes every blocking put and
+    # the scan loop give up instead of waiting on a queue nobody drains.
+    provider = get_provider()
+    load_workers = load_workers or LOAD_WORKERS
+    api_workers = api_workers or API_WORKERS or provider.caption_concurrency
+    batch_size = batch_size or WRITE_BATCH_SIZE
+    embed_batch_size = embed_batch_size or EMBED_BATCH_SIZE
+
+    in_flight = threading.BoundedSemaphore(
+        QUEUE_DEPTH_PER_WORKER * (load_workers + api_workers) + embed_batch_size
+    )
+    api_q: queue.Queue = queue.Queue(maxsize=QUEUE_DEPTH_PER_WORKER * api_workers)
+    embed_q: queue.Queue = queue.Queue(maxsize=embed_batch_size)
+    write_q: queue.Queue = queue.Queue(maxsize=QUEUE_DEPTH_PER_WORKER * batch_size)
+    progress = tqdm(desc="Indexing images", unit="img")
+    thumbs = get_thumb_cache()
+    UPLOAD_STATS.reset()
+
+    stop = threading.Event()
+
+    def fail(path, e):
+        print(f"[WARN] Failed indexing {path}: {e}")
+        METRICS.inc("index_images_total", result="failed")
+        in_flight.release()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=QUEUE_POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError("indexing stopped")
+
+    def guarded(target):
+        def run():
+            try:
+                target()
+            except BaseException as e:
+                print(f"[WARN] {threading.current_thread().name} failed, stopping indexing: {e}")
+                stop.set()
+        return run
+
+    def load(path, mtime, size, tags_only):
+        try:
+            if stop.is_set():
+                raise RuntimeError("indexing stopped")
+            content_hash = None
+            if not tags_only:
+                conn = get_conn()
+                try:
+                    with METRICS.timer("index_stage_seconds", stage="hash"):
+                        content_hash, cached = lookup_cached(conn, path)
+                finally:
+                    conn.close()
+                METRICS.inc("index_content_cache_total", result="miss" if cached is None else "hit")
+                if cached is not None:
+                    caption, tags, emb_blob, vec = cached
+                    if emb_blob is not None:
+                        put(write_q, ("upsert", path, mtime, caption, emb_blob, tags, content_hash, size, None, vec))
+                    else:
+                        put(embed_q, (path, mtime, caption, tags, content_hash, size, None))
+                    return
+            with METRICS.timer("index_stage_seconds", stage="decode"):
+                img_bytes, phash = load_image(
+                    path,
+                    max_side=provider.upload_max_side,
+                    quality=provider.upload_quality,
+                    thumb_cache=thumbs,
+                )
+            put(api_q, (path, mtime, size, tags_only, content_hash, img_bytes, phash))
+        except Exception as e:
+            fail(path, e)
+
+    def describe():
+        while True:
+            item = api_q.get()
+            if item is None:
+                return
+            path, mtime, size, tags_only, content_hash, img_bytes, phash = item
+            try:
+                if stop.is_set():
+                    raise RuntimeError("indexing stopped")
+                with METRICS.timer("index_stage_seconds", stage="caption"):
+                    caption, tags = provider.caption_and_tags(img_bytes)
+                if tags_only:
+                    put(write_q, ("tags", path, mtime, tags, phash))
+                else:
+                    put(embed_q, (path, mtime, caption, tags, content_hash, size, phash))
+            except Exception as e:
+                fail(path, e)
 
-    files = list(iter_images(folder))
-    for path in tqdm(files, desc="Indexing images"):
+    def embed_chunk(chunk):
         try:
-            mtime = os.path.getmtime(path)
-
-            row = conn.execute("SELECT mtime, deleted FROM images WHERE path=?", (path,)).fetchone()
-            if row:
-                prev_mtime, deleted = row
-                if rescan_tags_only and deleted == 0:
-                    img_bytes = load_image_bytes(path)
-                    _caption, tags = provider.caption_and_tags(img_bytes)
-                    update_tags(conn, path, mtime, tags)
+            with METRICS.timer("index_stage_seconds", stage="embed"):
+                embeddings = provider.embed_captions([item[2] for item in chunk])
+            if len(embeddings) != len(chunk):
+                raise ValueError(f"expected {len(chunk)} embeddings, got {len(embeddings)}")
+        except Exception:
+            # Isolate the item that broke the batch instead of failing all of them.
+            embeddings = []
+            for (_p, _m, caption, _t, _h, _s, _ph) in chunk:
+                try:
+                    embeddings.append(provider.embed_caption(caption))
+                except Exception as e:
+                    embeddings.append(e)
+        for (path, mtime, caption, tags, content_hash, size, phash), emb in zip(chunk, embeddings):
+            try:
+                if isinstance(emb, Exception):
+                    raise emb
+                vec = np.asarray(emb, dtype=np.float32)
+                emb_blob = sqlite3.Binary(floats_to_bytes(vec))
+                put(write_q, ("upsert", path, mtime, caption, emb_blob, tags, content_hash, size, phash, vec))
+            except Exception as e:
+                fail(path, e)
+
+    def embed():
+        chunk = []
+        while True:
+            try:
+                item = embed_q.get(timeout=EMBED_FLUSH_SECONDS if chunk else None)
+            except queue.Empty:
+                item = ()
+            if item:
+                chunk.append(item)
+            if chunk and (not item or len(chunk) >= embed_batch_size):
+                embed_chunk(chunk)
+                chunk = []
+            if item is None:
+                return
+
+    def write():
+        conn = get_conn()
+        pending = 0
+        after_commit: List[Callable[[], None]] = []
+
+        def commit():
+            nonlocal pending
+            if not pending:
+                return
+            try:
+                with METRICS.timer("index_stage_seconds", stage="commit"):
                     conn.commit()
-                    continue
-                if rescan_deleted_only and deleted == 0:
-                    continue
-                if not rescan_deleted_only and deleted == 0 and float(prev_mtime) == float(mtime):
-                    continue
-            elif rescan_deleted_only or rescan_tags_only:
-                continue
+            except Exception as e:
+                # e.g. "database is locked" or a full disk: drop this batch,
+                # keep draining so the rest of the pipeline can finish.
+                print(f"[WARN] Failed committing {pending} images: {e}")
+                METRICS.inc("index_images_total", pending, result="failed")
+                after_commit.clear()
+                try:
+                    conn.rollback()
+                except Exception as e:
+                    print(f"[WARN] Rollback failed: {e}")
+            else:
+                publish(after_commit)
+                METRICS.inc("index_images_total", pending, result="ok")
+                progress.update(pending)
+            pending = 0
 
-            img_bytes = load_image_bytes(path)
-            caption, tags = provider.caption_and_tags(img_bytes)
+        while True:
+            try:
+                item = write_q.get(timeout=WRITE_FLUSH_SECONDS)
+            except queue.Empty:
+                commit()
+                continue
+            if item is None:
+                break
+            try:
+                if item[0] == "tags":
+                    update_tags(conn, *item[1:], after_commit=after_commit)
+                else:
+                    upsert_image(conn, *item[1:], after_commit=after_commit)
+                pending += 1
+            except Exception as e:
+                print(f"[WARN] Failed indexing {item[1]}: {e}")
+                METRICS.inc("index_images_total", result="failed")
+            in_flight.release()
+            if pending >= batch_size:
+                commit()
+        commit()
+        conn.close()
 
-            emb = provider.embed_caption(caption)
-            emb_blob = sqlite3.Binary(_floats_to_bytes(emb))
+    def finish(q, threads):
+        # One sentinel per consumer, unless the consumers are gone.
+        for _ in threads:
+            while any(t.is_alive() for t in threads):
+                try:
+                    q.put(None, timeout=QUEUE_POLL_SECONDS)
+                    break
+                except queue.Full:
+                    pass
+        for t in threads:
+            t.join()
 
-            upsert_image(conn, path, mtime, caption, emb_blob, tags)
-            conn.commit()
+    writer = threading.Thread(target=guarded(write), name="index-writer", daemon=True)
+    writer.start()
+    describers = [
+        threading.Thread(target=guarded(describe), name=f"index-api-{i}", daemon=True)
+        for i in range(api_workers)
+    ]
+    for t in describers:
+        t.start()
+    embedder = threading.Thread(target=guarded(embed), name="index-embed", daemon=True)
+    embedder.start()
 
-        except Exception as e:
-            print(f"[WARN] Failed indexing {path}: {e}")
+    try:
+        with ThreadPoolExecutor(max_workers=load_workers, thread_name_prefix="index-load") as loaders:
+            for path, mtime, size, tags_only in jobs:
+                while not in_flight.acquire(timeout=QUEUE_POLL_SECONDS):
+                    if stop.is_set():
+                        break
+                if stop.is_set():
+                    raise RuntimeError("Indexing stopped because a pipeline thread failed")
+                loaders.submit(load, path, mtime, size, tags_only)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        finish(api_q, describers)
+        finish(embed_q, [embedder])
+        finish(write_q, [writer])
+        progress.close()
 
-    conn.close()
+    stats = UPLOAD_STATS.snapshot()
+    if stats["images"]:
+        print(
+            f"[INFO] Uploaded {stats['images']} images, "
+            f"{stats['avg_upload_bytes'] / 1024:.0f} KB per image "
+            f"({stats['passthrough']} sent without re-encoding)"
+        )
 
-def _floats_to_bytes(vec):
-    import numpy as np
-    arr = np.array(vec, dtype=np.float32)
-    return arr.tobytes()
+def floats_to_bytes(vec):
+    return encode_embedding(vec)
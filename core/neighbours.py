@@ -0,0 +1,154 @@
+import argparse
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+from core.db import get_conn, init_db
+from core.emb_store import EmbeddingStore, get_store
+
+# Precomputed k-nearest-neighbour graph over the stored embeddings, for
+# "more like this" without a query embedding or a full scan. Each image's
+# neighbours are one row in the neighbours table: ids and scores as packed
+# arrays, best first, plus the lowest score in the list (`floor`).
+#
+# Scores come from blocked matrix products: a block of QUERY_BLOCK images
+# against CANDIDATE_BLOCK candidates at a time, keeping a running top-k per
+# image, so memory stays bounded however large the library is. Updates are
+# incremental: images without a row (new, or re-embedded, since
+# upsert_image drops the row) get a fresh list, and existing lists only
+# change where one of those images beats their current floor. The default
+# k covers the app's first page plus its one-result look-ahead (61).
+NEIGHBOURS_K = int(os.getenv("NEIGHBOURS_K") or 64)
+QUERY_BLOCK = 1024
+CANDIDATE_BLOCK = 16_384
+WRITE_BATCH = 1000
+MERGE_BATCH = 500
+
+def _pack(ids: np.ndarray, scores: np.ndarray, k: int) -> Tuple[bytes, bytes, float]:
+    keep = ids >= 0
+    ids, scores = ids[keep], scores[keep]
+    # A short list can still take any newcomer.
+    floor = float(scores[-1]) if len(scores) >= k else -2.0
+    return ids.astype(np.int64).tobytes(), scores.astype(np.float32).tobytes(), floor
+
+def unpack(ids_blob: bytes, scores_blob: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    return np.frombuffer(ids_blob, dtype=np.int64), np.frombuffer(scores_blob, dtype=np.float32)
+
+def _top_k(store: EmbeddingStore, query_ids: np.ndarray, candidate_ids: np.ndarray, k: int):
+    # Yields (query ids, neighbour ids, scores) per query block; rows are
+    # best first and padded with -1 when there are fewer than k candidates.
+    # An image is never its own neighbour.
+    for qstart in range(0, len(query_ids), QUERY_BLOCK):
+        qids = query_ids[qstart:qstart + QUERY_BLOCK]
+        q = store.vectors(qids)
+        best_ids = np.full((len(qids), k), -1, dtype=np.int64)
+        best = np.full((len(qids), k), -np.inf, dtype=np.float32)
+        for cstart in range(0, len(candidate_ids), CANDIDATE_BLOCK):
+            cids = candidate_ids[cstart:cstart + CANDIDATE_BLOCK]
+            scores = q @ store.vectors(cids).T
+            scores[qids[:, None] == cids[None, :]] = -np.inf
+            scores = np.concatenate([best, scores], axis=1)
+            ids = np.concatenate([best_ids, np.broadcast_to(cids, (len(qids), len(cids)))], axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                ids = np.take_along_axis(ids, top, axis=1)
+            best, best_ids = scores, ids
+        order = np.argsort(-best, axis=1, kind="stable")
+        best = np.take_along_axis(best, order, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+        best_ids[~np.isfinite(best)] = -1
+        yield qids, best_ids, best
+
+def _merge(ids_blob, scores_blob, new_ids, new_scores, k):
+    old_ids, old_scores = unpack(ids_blob, scores_blob)
+    keep = ~np.isin(old_ids, new_ids)
+    ids = np.concatenate([old_ids[keep], new_ids[new_ids >= 0]])
+    scores = np.concatenate([old_scores[keep], new_scores[new_ids >= 0]])
+    order = np.argsort(-scores, kind="stable")[:k]
+    return ids[order], scores[order]
+
+def update_neighbours(k: Optional[int] = None, rebuild: bool = False) -> int:
+    # Returns the number of images that got a fresh neighbour list.
+    k = k or NEIGHBOURS_K
+    store = get_store()
+    store.refresh()
+    live = np.flatnonzero(store.live_mask())
+    conn = get_conn()
+    try:
+        if rebuild:
+            conn.execute("DELETE FROM neighbours")
+        have = np.array([r[0] for r in conn.execute("SELECT id FROM neighbours")], dtype=np.int64)
+        gone = np.setdiff1d(have, live)
+        if gone.size:
+            conn.executemany("DELETE FROM neighbours WHERE id=?", [(int(i),) for i in gone])
+        old = np.intersect1d(have, live)
+        new = np.setdiff1d(live, have)
+        if not new.size:
+            conn.commit()
+            return 0
+
+        # Existing lists first, while `old` still matches the table: only
+        # images where a newcomer beats the floor are rewritten.
+        if old.size:
+            floors = dict(conn.execute("SELECT id, floor FROM neighbours"))
+            for qids, cand_ids, cand_scores in _top_k(store, old, new, k):
+                floor = np.array([floors[int(i)] for i in qids], dtype=np.float32)
+                hit = cand_scores[:, 0] > floor
+                rows = [(int(i), cand_ids[j], cand_scores[j]) for j, i in enumerate(qids) if hit[j]]
+                for start in range(0, len(rows), MERGE_BATCH):
+                    batch = rows[start:start + MERGE_BATCH]
+                    marks = ",".join("?" * len(batch))
+                    current = {
+                        img_id: (ids_blob, scores_blob)
+                        for img_id, ids_blob, scores_blob in conn.execute(
+                            f"SELECT id, ids, scores FROM neighbours WHERE id IN ({marks})",
+                            [img_id for img_id, _i, _s in batch],
+                        )
+                    }
+                    updates = []
+                    for img_id, ids, scores in batch:
+                        merged = _merge(*current[img_id], ids, scores, k)
+                        updates.append((*_pack(*merged, k), img_id))
+                    conn.executemany("UPDATE neighbours SET ids=?, scores=?, floor=? WHERE id=?", updates)
+                conn.commit()
+
+        pending = []
+        for qids, ids, scores in _top_k(store, new, live, k):
+            pending.extend((int(i), *_pack(ids[j], scores[j], k)) for j, i in enumerate(qids))
+            if len(pending) >= WRITE_BATCH:
+                conn.executemany("INSERT OR REPLACE INTO neighbours(id, ids, scores, floor) VALUES(?, ?, ?, ?)", pending)
+                conn.commit()
+                pending = []
+        conn.executemany("INSERT OR REPLACE INTO neighbours(id, ids, scores, floor) VALUES(?, ?, ?, ?)", pending)
+        conn.commit()
+    finally:
+        conn.close()
+    return int(new.size)
+
+def graph_exists(conn) -> bool:
+    return conn.execute("SELECT EXISTS(SELECT 1 FROM neighbours)").fetchone()[0] == 1
+
+def update_if_built() -> int:
+    # Keeps an existing graph current after indexing. Building the first one
+    # compares every image with every other, so that is left to the CLI.
+    conn = get_conn()
+    try:
+        built = graph_exists(conn)
+    finally:
+        conn.close()
+    return update_neighbours() if built else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the nearest-neighbour graph for 'more like this'.")
+    parser.add_argument("--k", type=int, default=None, help=f"Neighbours per image (default {NEIGHBOURS_K}).")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute every list from scratch.")
+    args = parser.parse_args()
+    from core.emb_index import get_index
+    init_db()
+    get_index()
+    print(f"Updated neighbours for {update_neighbours(args.k, rebuild=args.rebuild)} images")
+
+if __name__ == "__main__":
+    main()
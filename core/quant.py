@@ -0,0 +1,98 @@
+import argparse
+import os
+import struct
+from typing import Tuple
+
+import numpy as np
+
+from core.db import get_conn, init_db
+
+# Embedding BLOB formats. float32 BLOBs are the raw vector, as they always
+# were. Compact formats start with an 8-byte header: a float32 NaN bit
+# pattern no real embedding starts with, then the format code.
+#   float16: header + dim * 2 bytes
+#   int8:    header + float32 scale + dim bytes; value = q * scale
+# EMBEDDING_FORMAT picks the format new rows are written in.
+FORMATS = ("float32", "float16", "int8")
+EMBEDDING_FORMAT = (os.getenv("EMBEDDING_FORMAT") or "float32").lower()
+MAGIC = struct.pack("<I", 0x7FC05147)
+HEADER = struct.Struct("<4sB3x")
+FORMAT_CODES = {"float16": 1, "int8": 2}
+CODE_FORMATS = {code: name for name, code in FORMAT_CODES.items()}
+MIGRATE_BATCH = 1000
+
+def quantize_int8(m: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Symmetric per-row quantization: rows ~= q * scale[:, None].
+    m = np.atleast_2d(np.asarray(m, dtype=np.float32))
+    scale = np.abs(m).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.clip(np.rint(m / scale[:, None]), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+def blob_format(blob: bytes) -> str:
+    if len(blob) >= HEADER.size and blob[:4] == MAGIC:
+        return CODE_FORMATS[HEADER.unpack_from(blob)[1]]
+    return "float32"
+
+def encode(vec, fmt: str = None) -> bytes:
+    fmt = fmt or EMBEDDING_FORMAT
+    arr = np.asarray(vec, dtype=np.float32).ravel()
+    if fmt == "float32":
+        return arr.tobytes()
+    if fmt == "float16":
+        return HEADER.pack(MAGIC, FORMAT_CODES[fmt]) + arr.astype(np.float16).tobytes()
+    if fmt == "int8":
+        q, scale = quantize_int8(arr)
+        return HEADER.pack(MAGIC, FORMAT_CODES[fmt]) + scale.tobytes() + q.tobytes()
+    raise ValueError(f"Unknown embedding format: {fmt}")
+
+def decode(blob: bytes) -> np.ndarray:
+    fmt = blob_format(blob)
+    if fmt == "float32":
+        return np.frombuffer(blob, dtype=np.float32)
+    if fmt == "float16":
+        return np.frombuffer(blob, dtype=np.float16, offset=HEADER.size).astype(np.float32)
+    scale = np.frombuffer(blob, dtype=np.float32, count=1, offset=HEADER.size)[0]
+    return np.frombuffer(blob, dtype=np.int8, offset=HEADER.size + 4).astype(np.float32) * scale
+
+def migrate(fmt: str, vacuum: bool = False) -> int:
+    # Rewrites stored embeddings in place. Search keeps using the sidecar
+    # store, which is not touched, but any rows it has to refill later come
+    # from these BLOBs, so their rerank rows hold the converted values.
+    conn = get_conn()
+    changed = 0
+    last_id = 0
+    try:
+        while True:
+            rows = conn.execute(
+                "SELECT id, embedding FROM images WHERE id > ? AND embedding IS NOT NULL ORDER BY id LIMIT ?",
+                (last_id, MIGRATE_BATCH),
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = [
+                (encode(decode(blob), fmt), img_id)
+                for img_id, blob in rows
+                if blob_format(blob) != fmt
+            ]
+            conn.executemany("UPDATE images SET embedding=? WHERE id=?", updates)
+            conn.commit()
+            changed += len(updates)
+        if vacuum and changed:
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return changed
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert stored embeddings to another format.")
+    parser.add_argument("--format", choices=FORMATS, required=True)
+    parser.add_argument("--vacuum", action="store_true", help="Compact gallery.db afterwards to reclaim the space.")
+    args = parser.parse_args()
+    init_db()
+    changed = migrate(args.format, vacuum=args.vacuum)
+    print(f"Converted {changed} embeddings to {args.format}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+from core.db import bump_generation, get_conn, init_db, pack_tags, unpack_tags
+from core.emb_index import notify_tag_bits
+from core.scanner import prefix_bounds
+from providers.base import _TAGGER
+
+# Recomputes tags from stored captions with the local caption tagger: no
+# images are read and no API is called. Captions stream out of the database
+# in id order, are tagged across a process pool, and only rows whose tags
+# changed are written back, one transaction per chunk. The content cache
+# entries of those rows get the new tags in the same transaction, so copies
+# and moved files indexed from the cache don't bring the old ones back.
+CHUNK_ROWS = 20_000
+RETAG_WORKERS = int(os.getenv("RETAG_WORKERS") or min(8, os.cpu_count() or 1))
+
+# Tagger bitmask -> (tag_bits, tag_known) as stored in images. Every tag the
+# tagger knows about is "known" after a retag, set or not.
+_PACKED = [
+    pack_tags({name: int(bool(mask & (1 << i))) for i, name in enumerate(_TAGGER.names)})
+    for mask in range(1 << len(_TAGGER.names))
+]
+
+def _tag_rows(rows: List[Tuple[int, str, int, int]]) -> Tuple[int, List[Tuple[int, int, int]]]:
+    match_bits = _TAGGER.match_bits
+    changed = []
+    for img_id, caption, old_bits, old_known in rows:
+        bits, known = _PACKED[match_bits(caption)]
+        # Tags outside the tagger's vocabulary keep whatever they had.
+        bits |= old_bits & ~known
+        known |= old_known
+        if bits != old_bits or known != old_known:
+            changed.append((bits, known, img_id))
+    return len(rows), changed
+
+def _chunks(conn, folder: Optional[str]) -> Iterator[List[Tuple[int, str, int, int]]]:
+    where = "deleted=0 AND caption IS NOT NULL"
+    params: Tuple = ()
+    if folder:
+        where += " AND path >= ? AND path < ?"
+        params = prefix_bounds(folder)
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            f"SELECT id, caption, tag_bits, tag_known FROM images WHERE {where} AND id > ? ORDER BY id LIMIT ?",
+            (*params, last_id, CHUNK_ROWS),
+        ).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield rows
+
+def retag(folder: Optional[str] = None, workers: Optional[int] = None) -> Tuple[int, int]:
+    # Returns (rows scanned, rows changed).
+    workers = workers or RETAG_WORKERS
+    read_conn = get_conn()
+    write_conn = get_conn()
+    scanned = changed = 0
+
+    def write(result):
+        nonlocal scanned, changed
+        count, updates = result
+        scanned += count
+        if not updates:
+            return
+        write_conn.executemany("UPDATE images SET tag_bits=?, tag_known=? WHERE id=?", updates)
+        write_conn.executemany(
+            "UPDATE content_cache SET tags=? WHERE hash=(SELECT content_hash FROM images WHERE id=?)",
+            [(json.dumps(unpack_tags(bits, known)), img_id) for (bits, known, img_id) in updates],
+        )
+        bump_generation(write_conn)
+        write_conn.commit()
+        changed += len(updates)
+        notify_tag_bits(
+            [img_id for (_b, _k, img_id) in updates],
+            [bits for (bits, _k, _i) in updates],
+            [known for (_b, known, _i) in updates],
+        )
+
+    try:
+        if workers > 1:
+            # A small window of chunks in flight keeps memory flat however
+            # large the library is.
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                for rows in _chunks(read_conn, folder):
+                    pending.append(pool.submit(_tag_rows, rows))
+                    if len(pending) >= 2 * workers:
+                        write(pending.popleft().result())
+                while pending:
+                    write(pending.popleft().result())
+        else:
+            for rows in _chunks(read_conn, folder):
+                write(_tag_rows(rows))
+    finally:
+        write_conn.close()
+        read_conn.close()
+    return scanned, changed
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute tags from stored captions (no API calls).")
+    parser.add_argument("--folder", default=None, help="Only retag images under this folder.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (1 = no pool).")
+    args = parser.parse_args()
+    init_db()
+    scanned, changed = retag(args.folder, args.workers)
+    print(f"Retagged {scanned} images, {changed} changed")
+
+if __name__ == "__main__":
+    main()
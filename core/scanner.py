@@ -0,0 +1,75 @@
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+SUPPORTED_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff"}
+
+def walk_images(root: str, errors: Optional[Set[str]] = None) -> Iterator[Tuple[str, os.stat_result]]:
+    # os.scandir reuses the directory listing, so on Windows the stat below
+    # costs nothing extra; directories that can't be read are reported in
+    # `errors` so callers don't mistake their files for removed ones.
+    stack = [str(Path(root))]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = list(it)
+        except OSError:
+            if errors is not None:
+                errors.add(current)
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in SUPPORTED_EXTS and entry.is_file():
+                    yield entry.path, entry.stat()
+            except OSError:
+                continue
+
+def prefix_bounds(root: str) -> Tuple[str, str]:
+    prefix = os.path.join(str(Path(root)), "")
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def is_changed(known: Optional[Tuple[float, Optional[int], int]], st: os.stat_result) -> bool:
+    if known is None:
+        return True
+    prev_mtime, prev_size, deleted = known
+    same_size = prev_size is None or prev_size == st.st_size
+    return not (deleted == 0 and float(prev_mtime) == float(st.st_mtime) and same_size)
+
+class FolderScan:
+    # One pass over a folder against what the database already knows about
+    # it. Iterating yields (path, mtime, size, known, changed) where `known`
+    # is the stored (mtime, size, deleted) row or None. Unchanged indexed
+    # files are skipped unless include_unchanged is set. After iteration,
+    # `vanished` lists indexed paths that are no longer on disk.
+    def __init__(self, conn: sqlite3.Connection, root: str, include_unchanged: bool = False):
+        self.root = str(Path(root))
+        self.include_unchanged = include_unchanged
+        lo, hi = prefix_bounds(self.root)
+        self.known: Dict[str, Tuple[float, Optional[int], int]] = {
+            path: (mtime, size, deleted)
+            for (path, mtime, size, deleted) in conn.execute(
+                "SELECT path, mtime, size, deleted FROM images WHERE path >= ? AND path < ?",
+                (lo, hi),
+            )
+        }
+        self.errors: Set[str] = set()
+        self.vanished: List[str] = []
+
+    def __iter__(self):
+        # Entries are popped as files are seen; whatever is left is gone.
+        remaining = self.known
+        for path, st in walk_images(self.root, self.errors):
+            known = remaining.pop(path, None)
+            changed = is_changed(known, st)
+            if changed or self.include_unchanged:
+                yield path, st.st_mtime, st.st_size, known, changed
+
+        failed = tuple(os.path.join(d, "") for d in self.errors)
+        self.vanished = [
+            path for path, (_m, _s, deleted) in remaining.items()
+            if deleted == 0 and not path.startswith(failed)
+        ]
@@ -1,55 +1,328 @@
+import os
+import re
+import sqlite3
+import threading
+import time
 import numpy as np
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from cachetools import LRUCache
 
-from core.db import get_conn
+from core.ann import DEFAULT_NPROBE, get_ann
+from core.db import TAG_BITS, get_conn, get_generation
+from core.emb_index import get_index
+from core.emb_store import get_store
+from core.neighbours import unpack as unpack_neighbours
+from core.quant import decode as decode_embedding
 from providers import get_provider
+from utils.metrics import METRICS
 
-def _bytes_to_floats(blob: bytes) -> np.ndarray:
-    return np.frombuffer(blob, dtype=np.float32)
+PERSIST_QUERY_EMBEDDINGS = (os.getenv("QUERY_CACHE_PERSIST") or "1") != "0"
+SEARCH_MODES = ("hybrid", "semantic", "lexical")
+DEFAULT_MODE = (os.getenv("SEARCH_MODE") or "hybrid").lower()
+RRF_K = 60
+RRF_DEPTH = 200
+# Deleted and filtered-out rows are still in the caption index, so fetch
+# extra keyword hits to fill the page after filtering.
+LEXICAL_OVERFETCH = 4
+# Exact scans use the int8 copy of the embeddings plus a full-precision
+# rerank once the library is large enough for memory bandwidth to matter.
+# SEARCH_QUANTIZED=1/0 forces it on or off. When the prefix pass below is
+# on, it replaces this one: it reads the first 256 values of the same int8
+# rows.
+QUANTIZED_SCAN = (os.getenv("SEARCH_QUANTIZED") or "auto").lower()
+QUANTIZED_MIN_ROWS = 100_000
+# Coarse-to-fine search: scan the 256-dim int8 prefix of every embedding,
+# then rerank `coarse` candidates per result on the full vectors. Smaller is
+# faster, larger recovers more of the exact ranking; 0 skips the prefix pass.
+# SEARCH_COARSE sets the default ("auto" uses COARSE_DEFAULT on large
+# libraries only); search(coarse=...) overrides it per query.
+COARSE_SETTING = (os.getenv("SEARCH_COARSE") or "auto").lower()
+COARSE_DEFAULT = 10
+# Rankings are computed this many results at a time and cached, so later
+# pages of the same search are slices of the cached ranking.
+RANK_DEPTH = 240
 
-def _cosine(a: np.ndarray, b: np.ndarray) -> float:
-    denom = (np.linalg.norm(a) * np.linalg.norm(b))
-    if denom == 0:
-        return 0.0
-    return float(np.dot(a, b) / denom)
+_cache_lock = threading.Lock()
+_query_embeddings: LRUCache = LRUCache(maxsize=1024)
+_results: LRUCache = LRUCache(maxsize=64)
+_providers: Dict[str, object] = {}
 
-def search(query: str, limit: int = 50, filters: Optional[Dict] = None) -> List[Dict]:
-    filters = filters or {}
-    provider = get_provider()
-    q_emb = np.array(provider.embed_text(query), dtype=np.float32)
+def _provider_name() -> str:
+    return (os.getenv("AI_PROVIDER") or "openai").lower()
 
-    conn = get_conn()
-    conditions = ["deleted=0", "embedding IS NOT NULL"]
+def _cached_provider():
+    name = _provider_name()
+    with _cache_lock:
+        provider = _providers.get(name)
+    if provider is None:
+        provider = get_provider()
+        with _cache_lock:
+            _providers[name] = provider
+    return provider
+
+def clear_caches():
+    with _cache_lock:
+        _query_embeddings.clear()
+        _results.clear()
+        _providers.clear()
+
+def embed_query(query: str) -> np.ndarray:
+    key = (_provider_name(), query)
+    with _cache_lock:
+        cached = _query_embeddings.get(key)
+    if cached is not None:
+        METRICS.inc("query_embedding_cache_total", result="memory")
+        return cached
+
+    q_emb = None
+    if PERSIST_QUERY_EMBEDDINGS:
+        conn = get_conn()
+        row = conn.execute(
+            "SELECT embedding FROM query_embeddings WHERE provider=? AND query=?", key
+        ).fetchone()
+        conn.close()
+        if row:
+            q_emb = _bytes_to_floats(row[0])
+            METRICS.inc("query_embedding_cache_total", result="db")
+    if q_emb is None:
+        METRICS.inc("query_embedding_cache_total", result="miss")
+        with METRICS.timer("search_stage_seconds", stage="embed_query"):
+            q_emb = np.array(_cached_provider().embed_text(query), dtype=np.float32)
+        if PERSIST_QUERY_EMBEDDINGS:
+            conn = get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings(provider, query, embedding) VALUES(?, ?, ?)",
+                (key[0], key[1], sqlite3.Binary(q_emb.tobytes())),
+            )
+            conn.commit()
+            conn.close()
+
+    with _cache_lock:
+        _query_embeddings[key] = q_emb
+    return q_emb
+
+def _bytes_to_floats(blob: bytes) -> np.ndarray:
+    return decode_embedding(blob)
+
+def _filter_bits(filters: Dict):
+    # (must_set, must_clear) bitmasks; unknown tags count as not set.
+    must_set = must_clear = 0
     if filters.get("exclude_people"):
-        conditions.append("(has_people IS NULL OR has_people=0)")
+        must_clear |= TAG_BITS["has_people"]
     if filters.get("exclude_faces"):
-        conditions.append("(has_faces IS NULL OR has_faces=0)")
+        must_clear |= TAG_BITS["has_faces"]
     if filters.get("exclude_text"):
-        conditions.append("(has_text IS NULL OR has_text=0)")
+        must_clear |= TAG_BITS["has_text"]
     if filters.get("only_documents"):
-        conditions.append("is_document=1")
+        must_set |= TAG_BITS["is_document"]
     if filters.get("only_screenshots"):
-        conditions.append("is_screenshot=1")
+        must_set |= TAG_BITS["is_screenshot"]
     env = filters.get("environment")
     if env == "Indoor":
-        conditions.append("is_indoor=1")
+        must_set |= TAG_BITS["is_indoor"]
     if env == "Outdoor":
-        conditions.append("is_outdoor=1")
+        must_set |= TAG_BITS["is_outdoor"]
+    return must_set, must_clear
+
+def _filter_mask(tag_bits: np.ndarray, tag_known: np.ndarray, filters: Dict) -> Optional[np.ndarray]:
+    must_set, must_clear = _filter_bits(filters)
+    if not (must_set or must_clear):
+        return None
+    return (tag_bits & np.uint16(must_set | must_clear)) == np.uint16(must_set)
+
+def _use_quantized(index) -> bool:
+    if QUANTIZED_SCAN == "auto":
+        return index.size >= QUANTIZED_MIN_ROWS
+    return QUANTIZED_SCAN not in ("0", "false", "no", "off")
+
+def _default_coarse(index) -> int:
+    if COARSE_SETTING == "auto":
+        return COARSE_DEFAULT if index.size >= QUANTIZED_MIN_ROWS else 0
+    return int(COARSE_SETTING)
+
+@METRICS.timed("search_stage_seconds", stage="semantic")
+def _semantic(index, q_emb: np.ndarray, depth: int, mask_fn, nprobe: int, coarse: int) -> List[Tuple[float, int]]:
+    ann = get_ann() if nprobe > 0 else None
+    top = None
+    if ann is not None:
+        # Higher nprobe trades latency for recall; fall back to the exact
+        # scan when the probed lists can't fill the page after filtering.
+        top = index.top_k(q_emb, depth, mask_fn, candidates=ann.candidates(q_emb, nprobe))
+    if top is None or len(top) < depth:
+        top = index.top_k(q_emb, depth, mask_fn, quantized=_use_quantized(index), coarse=coarse)
+    return top
+
+def _fts_query(query: str) -> str:
+    # Any of the query's words, each quoted so FTS5 syntax in user input is
+    # treated as plain text; BM25 ranks rows matching more of them higher.
+    words = re.findall(r"\w+", query.lower())
+    return " OR ".join(f'"{w}"' for w in words)
+
+@METRICS.timed("search_stage_seconds", stage="lexical")
+def _lexical(index, query: str, depth: int, mask_fn) -> List[Tuple[float, int]]:
+    match = _fts_query(query)
+    if not match:
+        return []
+    conn = get_conn()
+    try:
+        rows = conn.execute(
+            "SELECT rowid, bm25(images_fts) AS rank FROM images_fts "
+            "WHERE images_fts MATCH ? ORDER BY rank LIMIT ?",
+            (match, depth * LEXICAL_OVERFETCH),
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        conn.close()
+    if not rows:
+        return []
+    ids = np.array([r[0] for r in rows], dtype=np.int64)
+    allowed = index.allowed(ids, mask_fn)
+    # bm25() is lower-is-better; negate so scores sort like cosine scores.
+    return [(-float(rank), int(img_id)) for (img_id, rank), ok in zip(rows, allowed) if ok][:depth]
+
+def _fuse(rankings: List[List[Tuple[float, int]]], limit: int) -> List[Tuple[float, int]]:
+    # Reciprocal rank fusion: robust to the very different score scales of
+    # cosine similarity and BM25.
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, (_score, img_id) in enumerate(ranking):
+            fused[img_id] = fused.get(img_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    ordered = sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
+    return [(score, img_id) for img_id, score in ordered[:limit]]
+
+def search(
+    query: str,
+    limit: int = 50,
+    filters: Optional[Dict] = None,
+    nprobe: Optional[int] = None,
+    mode: Optional[str] = None,
+    coarse: Optional[int] = None,
+    offset: int = 0,
+) -> List[Dict]:
+    # mode: "hybrid" fuses semantic and keyword rankings, "semantic" is
+    # embeddings only, "lexical" uses the caption index alone and never
+    # calls the provider. Hybrid degrades to lexical if embedding fails.
+    # coarse: shortlist size per result for the prefix pass (see above).
+    # offset: results to skip, for paging through a ranking.
+    filters = filters or {}
+    nprobe = DEFAULT_NPROBE if nprobe is None else nprobe
+    mode = (mode or DEFAULT_MODE).lower()
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode}")
 
-    where_clause = " AND ".join(conditions)
-    rows = conn.execute(
-        f"SELECT id, path, caption, embedding FROM images WHERE {where_clause}"
-    ).fetchall()
+    # Reruns that don't change the query or the database hit this cache.
+    start = time.perf_counter()
+    conn = get_conn()
+    generation = get_generation(conn)
     conn.close()
+    key = (_provider_name(), query, tuple(sorted(filters.items())), nprobe, mode, coarse, generation)
+    end = offset + limit
+    with _cache_lock:
+        cached = _results.get(key)
+    if cached is not None:
+        depth, results = cached
+        # A ranking shorter than its depth already holds every match.
+        if end <= depth or len(results) < depth:
+            METRICS.observe("search_seconds", time.perf_counter() - start, mode=mode, cache="hit")
+            return [dict(r) for r in results[offset:end]]
+    limit = -(-end // RANK_DEPTH) * RANK_DEPTH
+
+    index = get_index()
+    coarse = _default_coarse(index) if coarse is None else coarse
+    mask_fn = lambda bits, known: _filter_mask(bits, known, filters)
+
+    q_emb = None
+    if mode != "lexical":
+        try:
+            q_emb = embed_query(query)
+        except Exception as e:
+            if mode == "semantic":
+                raise
+            print(f"[WARN] Query embedding failed, using keyword search only: {e}")
+
+    if q_emb is None:
+        top = _lexical(index, query, limit, mask_fn)
+    elif mode == "semantic":
+        top = _semantic(index, q_emb, limit, mask_fn, nprobe, coarse)
+    else:
+        depth = max(limit * 2, RRF_DEPTH)
+        top = _fuse(
+            [_semantic(index, q_emb, depth, mask_fn, nprobe, coarse), _lexical(index, query, depth, mask_fn)],
+            limit,
+        )
+
+    results = [
+        {"score": s, "id": img_id, "path": index.paths[img_id], "caption": index.captions[img_id]}
+        for (s, img_id) in top
+    ]
+    if cached is not None:
+        # Deepening a ranking can reorder fused results near the old depth;
+        # keep the part already paged through so pages never repeat or skip.
+        seen = {r["id"] for r in cached[1]}
+        results = cached[1] + [r for r in results if r["id"] not in seen]
+    if q_emb is not None or mode == "lexical":
+        # Don't pin a degraded keyword-only answer in the cache.
+        with _cache_lock:
+            _results[key] = (limit, results)
+    METRICS.observe("search_seconds", time.perf_counter() - start, mode=mode, cache="miss")
+    return [dict(r) for r in results[offset:end]]
+
+def similar(image_id: int, limit: int = 50, filters: Optional[Dict] = None, offset: int = 0) -> List[Dict]:
+    # Images closest to image_id. The precomputed neighbour graph serves the
+    # pages it covers; past the end of an image's list, a scan ranks only the
+    # rest (every image outside the list scores at most its floor), RANK_DEPTH
+    # results at a time, and is cached like search rankings. Images the graph
+    # doesn't know yet are scanned from the start. Never calls the provider.
+    filters = filters or {}
+    index = get_index()
+    if image_id >= index.size or not index.known[image_id]:
+        return []
+    mask_fn = lambda bits, known: _filter_mask(bits, known, filters)
+    end = offset + limit
+
+    conn = get_conn()
+    try:
+        generation = get_generation(conn)
+        row = conn.execute("SELECT ids, scores, floor FROM neighbours WHERE id=?", (image_id,)).fetchone()
+    finally:
+        conn.close()
+    top: List[Tuple[float, int]] = []
+    listed = np.empty(0, dtype=np.int64)
+    if row is not None:
+        listed, scores = unpack_neighbours(row[0], row[1])
+        allowed = index.allowed(listed, mask_fn)
+        top = [(float(s), int(i)) for i, s, ok in zip(listed, scores, allowed) if ok]
+        # A list shorter than k (floor -2) already holds every other image.
+        if len(top) >= end or row[2] < -1.0:
+            return _rows(index, top[offset:end])
+
+    key = ("similar", image_id, tuple(sorted(filters.items())), generation)
+    with _cache_lock:
+        cached = _results.get(key)
+    if cached is not None:
+        depth, ranked = cached
+        if end <= depth or len(ranked) < depth:
+            return _rows(index, ranked[offset:end])
+    depth = -(-end // RANK_DEPTH) * RANK_DEPTH
+    skip = np.append(listed, image_id)
+
+    def rest_mask(bits, known):
+        mask = _filter_mask(bits, known, filters)
+        mask = np.ones(len(bits), dtype=bool) if mask is None else mask.copy()
+        mask[skip[skip < len(bits)]] = False
+        return mask
 
-    scored = []
-    for (img_id, path, caption, emb_blob) in rows:
-        emb = _bytes_to_floats(emb_blob)
-        score = _cosine(q_emb, emb)
-        scored.append((score, img_id, path, caption))
+    q = get_store().vectors(np.array([image_id]))[0]
+    ranked = top + index.top_k(
+        q, depth - len(top), rest_mask, quantized=_use_quantized(index), coarse=_default_coarse(index)
+    )
+    with _cache_lock:
+        _results[key] = (depth, ranked)
+    return _rows(index, ranked[offset:end])
 
-    scored.sort(reverse=True, key=lambda x: x[0])
+def _rows(index, top: List[Tuple[float, int]]) -> List[Dict]:
     return [
-        {"score": s, "id": img_id, "path": path, "caption": caption}
-        for (s, img_id, path, caption) in scored[:limit]
+        {"score": s, "id": img_id, "path": index.paths[img_id], "caption": index.captions[img_id]}
+        for (s, img_id) in top
     ]
@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from core.db import get_conn, init_db
+from core.db_delete import mark_deleted
+from core.indexer import index_folder, index_paths, move_paths
+from core.scanner import SUPPORTED_EXTS, prefix_bounds
+
+# Keeps the index in step with the folders listed in .index_history.json.
+# Filesystem events are coalesced per path and applied once the tree has
+# been quiet for DEBOUNCE_SECONDS (or MAX_DELAY_SECONDS after the first
+# event, so a steady trickle of changes still gets indexed). Moves only
+# rewrite paths; deletes mark rows deleted; everything else goes through the
+# normal indexing pipeline for just the affected files.
+HISTORY_PATH = Path(__file__).resolve().parent.parent / ".index_history.json"
+DEBOUNCE_SECONDS = float(os.getenv("WATCH_DEBOUNCE_SECONDS") or 2.0)
+MAX_DELAY_SECONDS = float(os.getenv("WATCH_MAX_DELAY_SECONDS") or 30.0)
+
+INDEX = "index"
+DELETE = "delete"
+DELETE_TREE = "delete_tree"
+SCAN = "scan"
+
+def load_folders(path: Path = HISTORY_PATH) -> List[str]:
+    try:
+        with path.open("r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if not isinstance(data, list):
+        return []
+    return [str(x) for x in data]
+
+def _is_image(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in SUPPORTED_EXTS
+
+class _Handler(FileSystemEventHandler):
+    def __init__(self, watcher: "FolderWatcher"):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        self.watcher.record(
+            event.event_type,
+            os.fsdecode(event.src_path),
+            os.fsdecode(event.dest_path) if event.dest_path else "",
+            event.is_directory,
+        )
+
+class FolderWatcher:
+    def __init__(self, debounce: float = DEBOUNCE_SECONDS, max_delay: float = MAX_DELAY_SECONDS):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.observer = Observer()
+        self.watched: Dict[str, object] = {}
+        self._handler = _Handler(self)
+        self._lock = threading.Lock()
+        self._changes: Dict[str, str] = {}
+        self._moves: List[Tuple[str, str]] = []
+        self._first: Optional[float] = None
+        self._last: Optional[float] = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def watch(self, folder: str) -> bool:
+        folder = str(Path(folder))
+        if folder in self.watched or not os.path.isdir(folder):
+            return False
+        self.watched[folder] = self.observer.schedule(self._handler, folder, recursive=True)
+        return True
+
+    def record(self, kind: str, src: str, dst: str = "", is_dir: bool = False):
+        src = os.path.normpath(src)
+        dst = os.path.normpath(dst) if dst else ""
+        with self._lock:
+            if kind == "moved":
+                self._record_move(src, dst, is_dir)
+            elif is_dir:
+                if kind == "created":
+                    self._changes[src] = SCAN
+                elif kind == "deleted":
+                    self._changes[src] = DELETE_TREE
+                else:
+                    return
+            elif not _is_image(src):
+                return
+            elif kind in ("created", "modified", "closed"):
+                self._changes[src] = INDEX
+            elif kind == "deleted":
+                self._changes[src] = DELETE
+            else:
+                return
+            now = time.monotonic()
+            self._first = self._first or now
+            self._last = now
+        self._wake.set()
+
+    def _record_move(self, src: str, dst: str, is_dir: bool):
+        if is_dir:
+            # Pending work under the old directory follows it to the new one.
+            prefix = os.path.join(src, "")
+            for path in [p for p in self._changes if p.startswith(prefix)]:
+                self._changes[dst + path[len(src):]] = self._changes.pop(path)
+            self._moves.append((src, dst))
+            return
+        if _is_image(src):
+            self._changes.pop(src, None)
+            if _is_image(dst):
+                self._moves.append((src, dst))
+            else:
+                self._changes[src] = DELETE
+        if _is_image(dst):
+            # Indexing an unchanged, already-moved file is a cheap no-op; this
+            # covers files renamed before their first index and edits that
+            # were still pending under the old name.
+            self._changes[dst] = INDEX
+
+    def _take(self):
+        with self._lock:
+            if self._last is None:
+                return None
+            now = time.monotonic()
+            if now - self._last < self.debounce and now - self._first < self.max_delay:
+                return None
+            moves, changes = self._moves, self._changes
+            self._moves, self._changes = [], {}
+            self._first = self._last = None
+        return moves, changes
+
+    def _wait_time(self) -> Optional[float]:
+        with self._lock:
+            if self._last is None:
+                return None
+            now = time.monotonic()
+            due = min(self._last + self.debounce, self._first + self.max_delay)
+            return max(0.0, due - now)
+
+    def apply(self, moves: List[Tuple[str, str]], changes: Dict[str, str]):
+        to_index = [p for p, op in changes.items() if op == INDEX]
+        to_delete = [p for p, op in changes.items() if op == DELETE]
+        conn = get_conn()
+        try:
+            for src, dst in moves:
+                for old, new in move_paths(conn, src, dst):
+                    to_delete.append(old)
+                    to_index.append(new)
+            conn.commit()
+
+            for folder in (p for p, op in changes.items() if op == DELETE_TREE):
+                lo, hi = prefix_bounds(folder)
+                to_delete.extend(
+                    path for (path,) in conn.execute(
+                        "SELECT path FROM images WHERE deleted=0 AND path >= ? AND path < ?", (lo, hi)
+                    )
+                )
+        finally:
+            conn.close()
+
+        to_delete = list(dict.fromkeys(to_delete))
+        if to_delete:
+            mark_deleted(to_delete)
+        for folder in (p for p, op in changes.items() if op == SCAN):
+            index_folder(folder)
+        indexed = index_paths(to_index)
+        print(
+            f"[INFO] Applied {len(moves)} moves, {len(to_delete)} deletes, "
+            f"{indexed} files indexed"
+        )
+
+    def flush(self):
+        taken = self._take()
+        if taken is not None:
+            try:
+                self.apply(*taken)
+            except Exception as e:
+                print(f"[WARN] Failed applying changes: {e}")
+
+    def run(self, history: Optional[Path] = HISTORY_PATH, poll_seconds: float = 5.0):
+        # Blocks until stop(). The history file is re-read every few seconds
+        # so folders indexed from the app start being watched straight away.
+        self.observer.start()
+        history_mtime = None
+        try:
+            while not self._stop.is_set():
+                if history is not None:
+                    try:
+                        mtime = history.stat().st_mtime
+                    except OSError:
+                        mtime = None
+                    if mtime != history_mtime:
+                        history_mtime = mtime
+                        for folder in load_folders(history):
+                            if self.watch(folder):
+                                print(f"[INFO] Watching {folder}")
+                wait = self._wait_time()
+                self._wake.wait(poll_seconds if wait is None else min(wait, poll_seconds))
+                self._wake.clear()
+                self.flush()
+        finally:
+            self.observer.stop()
+            self.observer.join()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch indexed folders and keep the index up to date.")
+    parser.add_argument("folders", nargs="*", help="Folders to watch (default: the app's recent folders).")
+    parser.add_argument("--skip-initial-scan", action="store_true", help="Don't catch up on changes made while not watching.")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=HISTORY_PATH.parent / ".env", override=True)
+    init_db()
+
+    folders = args.folders or load_folders()
+    if not args.skip_initial_scan:
+        for folder in folders:
+            if os.path.isdir(folder):
+                index_folder(folder)
+
+    watcher = FolderWatcher()
+    for folder in folders:
+        if watcher.watch(folder):
+            print(f"[INFO] Watching {folder}")
+    try:
+        watcher.run(history=None if args.folders else HISTORY_PATH)
+    except KeyboardInterrupt:
+        watcher.stop()
+
+if __name__ == "__main__":
+    main()
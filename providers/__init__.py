@@ -1,6 +1,7 @@
 import os
 from .openai_provider import OpenAIProvider
 from .gemini_provider import GeminiProvider
+from .local_provider import LocalProvider
 
 def get_provider():
     name = (os.getenv("AI_PROVIDER") or "openai").lower()
@@ -9,5 +10,7 @@ def get_provider():
         return OpenAIProvider()
     if name == "gemini":
         return GeminiProvider()
+    if name in ("local", "mock"):
+        return LocalProvider()
 
     raise ValueError(f"Unknown AI_PROVIDER: {name}")
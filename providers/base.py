@@ -1,7 +1,18 @@
+import os
+import re
 from abc import ABC, abstractmethod
 from typing import Dict, List, Tuple
 
 class AIProvider(ABC):
+    # Size and JPEG quality of the image sent to the vision model. Providers
+    # that downscale server-side can lower these to cut upload volume.
+    upload_max_side = int(os.getenv("UPLOAD_MAX_SIDE") or 1024)
+    upload_quality = int(os.getenv("UPLOAD_QUALITY") or 85)
+    # Caption calls the indexer runs at once. Providers that pace calls with
+    # a RequestScheduler raise this to its max_concurrency and let its
+    # window decide how many actually go out.
+    caption_concurrency = 4
+
     @abstractmethod
     def caption_image(self, image_bytes: bytes) -> str:
         ...
@@ -10,51 +21,80 @@ class AIProvider(ABC):
     def embed_text(self, text: str) -> List[float]:
         ...
 
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_text(t) for t in texts]
+
     def embed_caption(self, caption: str) -> List[float]:
         return self.embed_text(caption)
 
+    def embed_captions(self, captions: List[str]) -> List[List[float]]:
+        return self.embed_texts(captions)
+
     def caption_and_tags(self, image_bytes: bytes) -> Tuple[str, Dict[str, int]]:
         caption = self.caption_image(image_bytes)
-        return caption, self._tags_from_caption(caption)
-
-    def _tags_from_caption(self, caption: str) -> Dict[str, int]:
-        text = (caption or "").lower()
-
-        def has_any(words):
-            return any(w in text for w in words)
-
-        has_people = has_any([
-            "person", "people", "man", "woman", "child", "boy", "girl", "baby",
-            "face", "selfie", "portrait", "crowd", "group",
-        ])
-        has_faces = has_any(["face", "selfie", "portrait"])
-        has_text = has_any([
-            "text", "writing", "handwritten", "notes", "note", "document",
-            "paper", "book", "page", "sign", "letter", "form", "invoice",
-            "receipt", "worksheet", "whiteboard",
-        ])
-        is_document = has_any([
-            "document", "paper", "letter", "form", "invoice", "receipt",
-            "notes", "notebook", "worksheet", "whiteboard",
-        ])
-        is_screenshot = has_any([
-            "screenshot", "screen", "ui", "app", "phone screen", "computer screen",
-        ])
-        is_indoor = has_any([
-            "indoor", "indoors", "room", "kitchen", "bedroom", "office",
-            "hall", "classroom", "living room",
-        ])
-        is_outdoor = has_any([
-            "outdoor", "outdoors", "outside", "street", "beach", "park",
-            "sky", "forest", "mountain",
-        ])
-
-        return {
-            "has_people": int(has_people),
-            "has_faces": int(has_faces),
-            "has_text": int(has_text),
-            "is_indoor": int(is_indoor),
-            "is_outdoor": int(is_outdoor),
-            "is_document": int(is_document),
-            "is_screenshot": int(is_screenshot),
-        }
+        return caption, self.tags_from_caption(caption)
+
+    def tags_from_caption(self, caption: str) -> Dict[str, int]:
+        return tags_from_caption(caption)
+
+# Words that set each tag when they appear in a caption, matched as whole
+# words (plurals included). Edit these and run `python -m core.retag` to
+# recompute tags for the whole library without calling the API.
+CAPTION_TAG_WORDS = {
+    "has_people": [
+        "person", "people", "man", "men", "woman", "women", "child", "children",
+        "boy", "girl", "baby", "face", "selfie", "portrait", "crowd", "group",
+    ],
+    "has_faces": ["face", "selfie", "portrait"],
+    "has_text": [
+        "text", "writing", "handwritten", "notes", "note", "document",
+        "paper", "book", "page", "sign", "letter", "form", "invoice",
+        "receipt", "worksheet", "whiteboard",
+    ],
+    "is_document": [
+        "document", "paper", "letter", "form", "invoice", "receipt",
+        "notes", "notebook", "worksheet", "whiteboard",
+    ],
+    "is_screenshot": [
+        "screenshot", "screen", "ui", "app", "phone screen", "computer screen",
+    ],
+    "is_indoor": [
+        "indoor", "indoors", "room", "kitchen", "bedroom", "office",
+        "hall", "classroom", "living room",
+    ],
+    "is_outdoor": [
+        "outdoor", "outdoors", "outside", "street", "beach", "park",
+        "sky", "forest", "mountain",
+    ],
+}
+
+class CaptionTagger:
+    # All vocabularies compiled into one alternation, so each caption is
+    # scanned once; every match ORs in the bits of the tags that use it.
+    def __init__(self, words: Dict[str, List[str]] = CAPTION_TAG_WORDS):
+        self.names = list(words)
+        self.bits: Dict[str, int] = {}
+        for i, name in enumerate(self.names):
+            for word in words[name]:
+                key = " ".join(word.lower().split())
+                self.bits[key] = self.bits.get(key, 0) | (1 << i)
+        alternation = "|".join(
+            r"\s+".join(re.escape(part) for part in word.split())
+            for word in sorted(self.bits, key=len, reverse=True)
+        )
+        self.pattern = re.compile(rf"\b({alternation})(?:s|es)?\b")
+
+    def match_bits(self, caption: str) -> int:
+        bits = 0
+        for m in self.pattern.finditer((caption or "").lower()):
+            bits |= self.bits[" ".join(m.group(1).split())]
+        return bits
+
+    def tags(self, caption: str) -> Dict[str, int]:
+        bits = self.match_bits(caption)
+        return {name: int(bool(bits & (1 << i))) for i, name in enumerate(self.names)}
+
+_TAGGER = CaptionTagger()
+
+def tags_from_caption(caption: str) -> Dict[str, int]:
+    return _TAGGER.tags(caption)
@@ -0,0 +1,169 @@
+import base64
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .local_provider import LocalProvider
+from .openai_provider import CAPTION_PROMPT, EMBED_MODEL, VISION_MODEL, OpenAIProvider, TAG_KEYS
+
+# Asynchronous batch endpoints. Requests and results use the OpenAI batch
+# JSONL format; the local backend reads and writes the same format so the
+# whole batch path can run offline.
+CAPTION_ENDPOINT = "/v1/responses"
+EMBED_ENDPOINT = "/v1/embeddings"
+# Per-file limits of the OpenAI batch API, with headroom on the size.
+MAX_BATCH_REQUESTS = 50_000
+MAX_BATCH_BYTES = 180 * 1024 * 1024
+
+FINISHED = ("completed", "failed", "expired", "cancelled")
+
+def caption_request(custom_id: str, image_bytes: bytes) -> Dict:
+    b64 = base64.b64encode(image_bytes).decode("utf-8")
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": CAPTION_ENDPOINT,
+        "body": {
+            "model": VISION_MODEL,
+            "text": {"format": {"type": "json_object"}},
+            "input": [{
+                "role": "user",
+                "content": [
+                    {"type": "input_text", "text": CAPTION_PROMPT},
+                    {"type": "input_image", "image_url": f"data:image/jpeg;base64,{b64}"},
+                ],
+            }],
+        },
+    }
+
+def embed_request(custom_id: str, text: str) -> Dict:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": EMBED_ENDPOINT,
+        "body": {"model": EMBED_MODEL, "input": text},
+    }
+
+def iter_results(text: str) -> Iterator[Tuple[str, Optional[Dict]]]:
+    # Yields (custom_id, response body); body is None for failed requests.
+    for line in (text or "").splitlines():
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        response = row.get("response") or {}
+        body = response.get("body") if response.get("status_code") == 200 else None
+        yield row.get("custom_id"), body
+
+def response_text(body: Dict) -> str:
+    # The raw Responses API body; output_text is only an SDK convenience.
+    parts = []
+    for item in body.get("output") or []:
+        if item.get("type") != "message":
+            continue
+        for content in item.get("content") or []:
+            if content.get("type") == "output_text":
+                parts.append(content.get("text") or "")
+    return "".join(parts).strip()
+
+def embedding(body: Dict) -> List[float]:
+    return body["data"][0]["embedding"]
+
+class OpenAIBatchBackend:
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, path: Path, endpoint: str, key: str) -> str:
+        # The job key travels as batch metadata, so a crash between creating
+        # the batch and recording its id doesn't submit the file twice.
+        for batch in self.client.batches.list(limit=100).data:
+            if (batch.metadata or {}).get("gallery_job") == key and batch.status not in FINISHED[1:]:
+                return batch.id
+        with Path(path).open("rb") as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=endpoint,
+            completion_window="24h",
+            metadata={"gallery_job": key},
+        )
+        return batch.id
+
+    def fetch(self, remote_id: str) -> Tuple[str, Optional[str]]:
+        # Returns (status, output JSONL); output is None until the batch has
+        # finished. Expired batches still return what they completed.
+        batch = self.client.batches.retrieve(remote_id)
+        if batch.status not in FINISHED:
+            return batch.status, None
+        if not batch.output_file_id:
+            return batch.status, ""
+        return batch.status, self.client.files.content(batch.output_file_id).text
+
+class LocalBatchBackend:
+    # File-based stand-in for the batch endpoint: submitting copies the input
+    # into root/<key>/, and the batch "completes" LOCAL_BATCH_DELAY_SECONDS
+    # later, answered by LocalProvider.
+    def __init__(self, root: Path, provider: Optional[LocalProvider] = None, delay: Optional[float] = None):
+        self.root = Path(root)
+        self.provider = provider or LocalProvider()
+        self.delay = float(os.getenv("LOCAL_BATCH_DELAY_SECONDS") or 0) if delay is None else delay
+
+    def submit(self, path: Path, endpoint: str, key: str) -> str:
+        job_dir = self.root / key
+        if not (job_dir / "input.jsonl").exists():
+            job_dir.mkdir(parents=True, exist_ok=True)
+            tmp = job_dir / "input.jsonl.tmp"
+            shutil.copyfile(path, tmp)
+            tmp.replace(job_dir / "input.jsonl")
+            (job_dir / "submitted").write_text(str(time.time()), encoding="utf-8")
+        return key
+
+    def fetch(self, remote_id: str) -> Tuple[str, Optional[str]]:
+        job_dir = self.root / remote_id
+        output = job_dir / "output.jsonl"
+        if not output.exists():
+            try:
+                submitted = float((job_dir / "submitted").read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                return "failed", ""
+            if time.time() - submitted < self.delay:
+                return "in_progress", None
+            self._process(job_dir / "input.jsonl", output)
+        return "completed", output.read_text(encoding="utf-8")
+
+    def _process(self, src: Path, dst: Path):
+        tmp = dst.with_suffix(".tmp")
+        with src.open("r", encoding="utf-8") as fin, tmp.open("w", encoding="utf-8") as fout:
+            for line in fin:
+                request = json.loads(line)
+                try:
+                    body = self._answer(request["url"], request["body"])
+                    response = {"status_code": 200, "body": body}
+                    error = None
+                except Exception as e:
+                    response = None
+                    error = {"message": str(e)}
+                fout.write(json.dumps({
+                    "custom_id": request["custom_id"], "response": response, "error": error,
+                }) + "\n")
+        tmp.replace(dst)
+
+    def _answer(self, url: str, body: Dict) -> Dict:
+        if url == EMBED_ENDPOINT:
+            vec = self.provider.embed_text(body["input"])
+            return {"data": [{"index": 0, "embedding": vec}]}
+        content = body["input"][0]["content"]
+        image_url = next(c["image_url"] for c in content if c["type"] == "input_image")
+        image_bytes = base64.b64decode(image_url.split(",", 1)[1])
+        caption, tags = self.provider.caption_and_tags(image_bytes)
+        reply = {"caption": caption, **{key: bool(tags.get(key)) for key in TAG_KEYS}}
+        return {"output": [{"type": "message", "content": [{"type": "output_text", "text": json.dumps(reply)}]}]}
+
+def get_batch_backend(provider, root: Path):
+    if isinstance(provider, OpenAIProvider):
+        return OpenAIBatchBackend(provider.client)
+    if isinstance(provider, LocalProvider):
+        return LocalBatchBackend(root, provider)
+    raise RuntimeError(f"Batch indexing is not supported for {type(provider).__name__}")
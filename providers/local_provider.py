@@ -0,0 +1,78 @@
+# Deterministic offline provider for benchmarks and development. Captions and
+# embeddings are derived from content hashes, so the same image always gets
+# the same caption and similar captions get similar vectors.
+import hashlib
+import os
+import time
+from functools import lru_cache
+from typing import List
+
+import numpy as np
+
+from .base import AIProvider
+
+SUBJECTS = [
+    "handwritten math notes on lined paper",
+    "a whiteboard with equations",
+    "a printed invoice document",
+    "a shop receipt",
+    "a phone screenshot of a chat app",
+    "a computer screen with code",
+    "a group of people at a party",
+    "a portrait of a woman smiling",
+    "a selfie of a man",
+    "a child playing with a dog",
+    "a busy street at night",
+    "a sandy beach at sunset",
+    "a mountain landscape with a lake",
+    "a forest trail",
+    "a cat sleeping on a sofa",
+    "a plate of pasta",
+    "a bookshelf full of books",
+    "a passport photo",
+]
+PLACES = [
+    "indoors",
+    "outdoors",
+    "in an office",
+    "in a classroom",
+    "in a kitchen",
+    "in a living room",
+    "in a park",
+    "under a cloudy sky",
+]
+
+class LocalProvider(AIProvider):
+    def __init__(self):
+        self.dim = int(os.getenv("LOCAL_EMBED_DIM") or 1536)
+        self.caption_latency = float(os.getenv("LOCAL_CAPTION_LATENCY_MS") or 0) / 1000
+        self.embed_latency = float(os.getenv("LOCAL_EMBED_LATENCY_MS") or 0) / 1000
+
+    def caption_image(self, image_bytes: bytes) -> str:
+        if self.caption_latency:
+            time.sleep(self.caption_latency)
+        digest = hashlib.blake2b(image_bytes, digest_size=8).digest()
+        subject = SUBJECTS[digest[0] % len(SUBJECTS)]
+        place = PLACES[digest[1] % len(PLACES)]
+        return f"{subject} {place}"
+
+    def embed_text(self, text: str) -> List[float]:
+        return self.embed_texts([text])[0]
+
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        # One simulated round trip per call, as with a real batched endpoint.
+        if self.embed_latency:
+            time.sleep(self.embed_latency)
+        return [_hash_embedding(t, self.dim).tolist() for t in texts]
+
+@lru_cache(maxsize=4096)
+def _token_vector(token: str, dim: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+def _hash_embedding(text: str, dim: int) -> np.ndarray:
+    vec = np.zeros(dim, dtype=np.float32)
+    for token in (text or "").lower().split():
+        vec += _token_vector(token, dim)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm > 0 else vec
@@ -1,76 +1,135 @@
 import base64
 import json
 import os
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 from openai import OpenAI
 from .base import AIProvider
+from .scheduler import get_scheduler
+
+VISION_MODEL = "gpt-4.1-mini"
+EMBED_MODEL = "text-embedding-3-small"
+CAPTION_PROMPT = (
+    "Return JSON with keys: caption (string), has_people, has_faces, "
+    "has_text, is_indoor, is_outdoor, is_document, is_screenshot. "
+    "Use true/false for flags. Keep caption concise but specific."
+)
+TAG_KEYS = (
+    "has_people", "has_faces", "has_text", "is_indoor", "is_outdoor", "is_document", "is_screenshot",
+)
+# The embeddings endpoint accepts at most 2048 inputs per request.
+MAX_EMBED_INPUTS = 2048
+# Default limits match the first usage tier; raise them with OPENAI_VISION_RPM,
+# OPENAI_VISION_TPM, OPENAI_EMBED_RPM and OPENAI_EMBED_TPM.
+VISION_RPM, VISION_TPM = 500, 200_000
+EMBED_RPM, EMBED_TPM = 3_000, 1_000_000
+# Rough cost of one vision call before the real usage is known: a ~1024px
+# image, the prompt and a short answer.
+VISION_TOKEN_ESTIMATE = 1_200
+
+def _usage_tokens(resp):
+    return resp.usage.total_tokens
+
+def _text_tokens(texts: List[str]) -> int:
+    return sum(len(t) // 4 + 1 for t in texts)
+
+def parse_caption_reply(text: str) -> Optional[Tuple[str, Dict[str, int]]]:
+    # None when the model didn't answer with the JSON object we asked for.
+    try:
+        data = json.loads(text or "{}")
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    caption = str(data.get("caption") or "").strip()
+    return caption, {key: int(bool(data.get(key))) for key in TAG_KEYS}
 
 class OpenAIProvider(AIProvider):
     def __init__(self):
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise RuntimeError("OPENAI_API_KEY is missing")
-        self.client = OpenAI(api_key=api_key)
+        # Retries are left to the scheduler so a 429 backs off every worker,
+        # not just the thread that hit it.
+        self.client = OpenAI(api_key=api_key, max_retries=0)
+        self._vision = get_scheduler("openai-vision", VISION_RPM, VISION_TPM)
+        self._embed = get_scheduler("openai-embed", EMBED_RPM, EMBED_TPM)
+        self.caption_concurrency = self._vision.max_concurrency
 
     def caption_image(self, image_bytes: bytes) -> str:
         return self._caption_only(image_bytes)
 
     def caption_and_tags(self, image_bytes: bytes) -> Tuple[str, Dict[str, int]]:
         b64 = base64.b64encode(image_bytes).decode("utf-8")
-        prompt = (
-            "Return JSON with keys: caption (string), has_people, has_faces, "
-            "has_text, is_indoor, is_outdoor, is_document, is_screenshot. "
-            "Use true/false for flags. Keep caption concise but specific."
-        )
-        try:
-            resp = self.client.responses.create(
-                model="gpt-4.1-mini",
-                response_format={"type": "json_object"},
+        resp = self._vision.call(
+            lambda: self.client.responses.create(
+                model=VISION_MODEL,
+                text={"format": {"type": "json_object"}},
                 input=[{
                     "role": "user",
                     "content": [
-                        {"type": "input_text", "text": prompt},
+                        {"type": "input_text", "text": CAPTION_PROMPT},
                         {"type": "input_image", "image_url": f"data:image/jpeg;base64,{b64}"},
                     ],
                 }],
-            )
-            data = json.loads(resp.output_text or "{}")
-            caption = (data.get("caption") or "").strip()
-            tags = {
-                "has_people": int(bool(data.get("has_people"))),
-                "has_faces": int(bool(data.get("has_faces"))),
-                "has_text": int(bool(data.get("has_text"))),
-                "is_indoor": int(bool(data.get("is_indoor"))),
-                "is_outdoor": int(bool(data.get("is_outdoor"))),
-                "is_document": int(bool(data.get("is_document"))),
-                "is_screenshot": int(bool(data.get("is_screenshot"))),
-            }
-            if not caption:
-                caption = self._caption_only(image_bytes)
-            return caption, tags
-        except Exception:
+            ),
+            tokens=VISION_TOKEN_ESTIMATE,
+            usage=_usage_tokens,
+        )
+        # API errors (including rate limits the scheduler gave up on) have
+        # already been raised. What's left is a reply that isn't the JSON we
+        # asked for: use it as the caption rather than paying for a second call.
+        text = (resp.output_text or "").strip()
+        parsed = parse_caption_reply(text)
+        if parsed is None:
+            return text, self.tags_from_caption(text)
+
+        caption, tags = parsed
+        if not caption:
             caption = self._caption_only(image_bytes)
-            return caption, self._tags_from_caption(caption)
+        return caption, tags
 
     def _caption_only(self, image_bytes: bytes) -> str:
         b64 = base64.b64encode(image_bytes).decode("utf-8")
 
-        resp = self.client.responses.create(
-            model="gpt-4.1-mini",
-            input=[{
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": "Describe this image for photo search. Be concise but specific."},
-                    {"type": "input_image", "image_url": f"data:image/jpeg;base64,{b64}"},
-                ],
-            }],
+        resp = self._vision.call(
+            lambda: self.client.responses.create(
+                model=VISION_MODEL,
+                input=[{
+                    "role": "user",
+                    "content": [
+                        {"type": "input_text", "text": "Describe this image for photo search. Be concise but specific."},
+                        {"type": "input_image", "image_url": f"data:image/jpeg;base64,{b64}"},
+                    ],
+                }],
+            ),
+            tokens=VISION_TOKEN_ESTIMATE,
+            usage=_usage_tokens,
         )
 
         return resp.output_text.strip()
 
     def embed_text(self, text: str) -> List[float]:
-        emb = self.client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text
+        emb = self._embed.call(
+            lambda: self.client.embeddings.create(
+                model=EMBED_MODEL,
+                input=text
+            ),
+            tokens=_text_tokens([text]),
+            usage=_usage_tokens,
         )
         return emb.data[0].embedding
+
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        out: List[List[float]] = []
+        for start in range(0, len(texts), MAX_EMBED_INPUTS):
+            chunk = texts[start:start + MAX_EMBED_INPUTS]
+            emb = self._embed.call(
+                lambda: self.client.embeddings.create(
+                    model=EMBED_MODEL,
+                    input=chunk
+                ),
+                tokens=_text_tokens(chunk),
+                usage=_usage_tokens,
+            )
+            out.extend(d.embedding for d in sorted(emb.data, key=lambda d: d.index))
+        return out
@@ -0,0 +1,238 @@
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional, TypeVar
+
+from utils.metrics import METRICS
+
+# Shared pacing for provider API calls. Every call reserves one request and
+# an estimated number of tokens from per-minute token buckets, then runs
+# inside an AIMD concurrency window: each success widens the window a little,
+# a rate-limit response halves it and pauses the buckets for Retry-After (or
+# an exponential backoff). Rate limits and transient server errors are
+# retried here; every other error is raised to the caller immediately.
+MAX_RETRIES = int(os.getenv("PROVIDER_MAX_RETRIES") or 6)
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+BURST_SECONDS = 10.0
+DECREASE_FACTOR = 0.5
+
+OK = "ok"
+RATE_LIMIT = "rate_limit"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+T = TypeVar("T")
+
+def retry_after_seconds(headers) -> Optional[float]:
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def classify(exc: BaseException):
+    # Returns (kind, retry_after). Works off attributes shared by the OpenAI
+    # and Google clients so this module doesn't import either SDK.
+    status = getattr(exc, "status_code", None)
+    if not isinstance(status, int):
+        code = getattr(exc, "code", None)
+        status = code if isinstance(code, int) else None
+    response = getattr(exc, "response", None)
+    retry_after = retry_after_seconds(getattr(response, "headers", None))
+    if status == 429:
+        # An exhausted quota looks like a rate limit but never clears by waiting.
+        if "insufficient_quota" in str(exc):
+            return FATAL, None
+        return RATE_LIMIT, retry_after
+    if status in (408, 409, 500, 502, 503, 504):
+        return TRANSIENT, retry_after
+    name = type(exc).__name__
+    if status is None and ("Timeout" in name or "Connection" in name):
+        return TRANSIENT, None
+    return FATAL, None
+
+class TokenBucket:
+    # Refills continuously at per_minute/60 per second and holds up to
+    # BURST_SECONDS worth. reserve() always succeeds and returns how long the
+    # caller must wait, so waiters are served in arrival order.
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        start = max(self.updated, self.paused_until)
+        if now > start:
+            self.level = min(self.capacity, self.level + (now - start) * self.rate)
+        self.updated = max(self.updated, now)
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.level -= amount
+            wait = max(0.0, self.paused_until - now)
+            if self.level < 0:
+                wait = max(wait, -self.level / self.rate)
+            return wait
+
+    def adjust(self, amount: float):
+        # Settles an estimate against the real usage (positive = overspent).
+        with self._lock:
+            self.level = min(self.capacity, self.level - amount)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.level = min(self.level, 0.0)
+
+class RequestScheduler:
+    def __init__(
+        self,
+        name: str,
+        rpm: float,
+        tpm: Optional[float] = None,
+        max_concurrency: int = 16,
+        min_concurrency: int = 1,
+    ):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(min(max_concurrency, max(min_concurrency, 4)))
+        self._active = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self.calls = 0
+        self.throttled = 0
+        self.retries = 0
+
+    def _enter(self):
+        with self._cond:
+            while self._active >= int(self.limit):
+                self._cond.wait()
+            self._active += 1
+
+    def _exit(self, result: str, retry_after: float = 0.0):
+        # Only successes widen the window; other failures leave it as is.
+        with self._cond:
+            self._active -= 1
+            now = time.monotonic()
+            if result == RATE_LIMIT:
+                self.throttled += 1
+                # One cut per congestion episode, not one per failed call
+                # that was already in flight when the limit hit.
+                if now - self._last_decrease > max(retry_after, 1.0):
+                    self.limit = max(float(self.min_concurrency), self.limit * DECREASE_FACTOR)
+                    self._last_decrease = now
+            elif result == OK:
+                self.calls += 1
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def _pause(self, seconds: float):
+        self.requests.pause(seconds)
+        if self.tokens is not None:
+            self.tokens.pause(seconds)
+
+    def call(
+        self,
+        fn: Callable[[], T],
+        tokens: float = 0,
+        usage: Optional[Callable[[T], Optional[int]]] = None,
+    ) -> T:
+        attempt = 0
+        while True:
+            wait = self.requests.reserve(1)
+            if self.tokens is not None and tokens:
+                wait = max(wait, self.tokens.reserve(tokens))
+            if wait > 0:
+                METRICS.observe("provider_wait_seconds", wait, endpoint=self.name)
+                time.sleep(wait)
+
+            self._enter()
+            start = time.perf_counter()
+            try:
+                result = fn()
+            except Exception as e:
+                kind, retry_after = classify(e)
+                METRICS.observe("provider_call_seconds", time.perf_counter() - start, endpoint=self.name)
+                METRICS.inc("provider_calls_total", endpoint=self.name, result=kind)
+                self._exit(kind, retry_after=retry_after or 0.0)
+                if kind == FATAL or attempt >= MAX_RETRIES:
+                    raise
+                delay = retry_after
+                if delay is None:
+                    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+                if kind == RATE_LIMIT:
+                    self._pause(delay)
+                else:
+                    time.sleep(delay)
+                attempt += 1
+                self.retries += 1
+                METRICS.inc("provider_retries_total", endpoint=self.name, reason=kind)
+                continue
+
+            METRICS.observe("provider_call_seconds", time.perf_counter() - start, endpoint=self.name)
+            METRICS.inc("provider_calls_total", endpoint=self.name, result=OK)
+            self._exit(OK)
+            if usage is not None and self.tokens is not None:
+                try:
+                    used = usage(result)
+                except Exception:
+                    used = None
+                if used is not None:
+                    self.tokens.adjust(used - tokens)
+            return result
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._cond:
+            return {
+                "calls": self.calls,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "concurrency": self.limit,
+            }
+
+_SCHEDULERS: Dict[str, RequestScheduler] = {}
+_SCHEDULERS_LOCK = threading.Lock()
+
+def get_scheduler(name: str, rpm: float, tpm: Optional[float] = None, max_concurrency: int = 16) -> RequestScheduler:
+    # One scheduler per endpoint for the whole process, so every indexing
+    # thread shares the same budget. Limits can be overridden per endpoint,
+    # e.g. OPENAI_VISION_RPM / OPENAI_VISION_TPM / OPENAI_VISION_CONCURRENCY.
+    with _SCHEDULERS_LOCK:
+        scheduler = _SCHEDULERS.get(name)
+        if scheduler is None:
+            prefix = name.upper().replace("-", "_")
+            scheduler = RequestScheduler(
+                name,
+                rpm=float(os.getenv(f"{prefix}_RPM") or rpm),
+                tpm=float(os.getenv(f"{prefix}_TPM") or tpm or 0) or None,
+                max_concurrency=int(os.getenv(f"{prefix}_CONCURRENCY") or max_concurrency),
+            )
+            _SCHEDULERS[name] = scheduler
+        return scheduler
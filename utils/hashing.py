@@ -0,0 +1,27 @@
+import hashlib
+import os
+
+SAMPLE_BYTES = 64 * 1024
+READ_CHUNK = 1024 * 1024
+
+def quick_hash(path: str) -> str:
+    # File size plus the first, middle and last 64 KiB. Cheap enough to run
+    # on every file; see full_hash for disambiguating real collisions.
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(size.to_bytes(8, "little"))
+    with open(path, "rb") as f:
+        if size <= 3 * SAMPLE_BYTES:
+            h.update(f.read())
+        else:
+            for offset in (0, (size - SAMPLE_BYTES) // 2, size - SAMPLE_BYTES):
+                f.seek(offset)
+                h.update(f.read(SAMPLE_BYTES))
+    return "q:" + h.hexdigest()
+
+def full_hash(path: str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+            h.update(chunk)
+    return "f:" + h.hexdigest()
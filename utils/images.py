@@ -1,14 +1,103 @@
-from PIL import Image
+import os
+import threading
 from io import BytesIO
+from typing import Dict, Tuple
 
-def load_image_bytes(path: str, max_side: int = 1024) -> bytes:
-    img = Image.open(path).convert("RGB")
-    w, h = img.size
+from PIL import Image, ImageOps
 
-    scale = max(w, h) / max_side
-    if scale > 1:
-        img = img.resize((int(w / scale), int(h / scale)))
+from utils.metrics import METRICS
 
-    buf = BytesIO()
-    img.save(buf, format="JPEG", quality=85)
-    return buf.getvalue()
+EXIF_ORIENTATION = 0x0112
+# Small JPEGs are uploaded as-is rather than decoded and re-encoded.
+PASSTHROUGH_MAX_BYTES = int(os.getenv("UPLOAD_PASSTHROUGH_KB") or 300) * 1024
+
+class UploadStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.images = 0
+        self.passthrough = 0
+        self.source_bytes = 0
+        self.upload_bytes = 0
+
+    def record(self, source_bytes: int, upload_bytes: int, passthrough: bool):
+        METRICS.inc("source_bytes_total", source_bytes)
+        METRICS.inc("upload_bytes_total", upload_bytes)
+        METRICS.inc("upload_images_total", passthrough=str(passthrough).lower())
+        with self._lock:
+            self.images += 1
+            self.passthrough += int(passthrough)
+            self.source_bytes += source_bytes
+            self.upload_bytes += upload_bytes
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            n = max(self.images, 1)
+            return {
+                "images": self.images,
+                "passthrough": self.passthrough,
+                "source_bytes": self.source_bytes,
+                "upload_bytes": self.upload_bytes,
+                "avg_upload_bytes": self.upload_bytes / n,
+            }
+
+UPLOAD_STATS = UploadStats()
+
+HASH_SIZE = 8
+
+def dhash(img: Image.Image) -> int:
+    # 64-bit difference hash: one bit per pixel of a 9x8 grayscale copy,
+    # set when it is brighter than its right-hand neighbour. Re-saved,
+    # resized and lightly edited copies land within a few bits of each
+    # other. Returned signed so it fits an SQLite INTEGER.
+    small = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX)
+    px = small.tobytes()
+    bits = 0
+    for row in range(HASH_SIZE):
+        start = row * (HASH_SIZE + 1)
+        for col in range(start, start + HASH_SIZE):
+            bits = (bits << 1) | (px[col] > px[col + 1])
+    return bits - (1 << 64) if bits >= (1 << 63) else bits
+
+def load_image_bytes(path: str, max_side: int = 1024, thumb_cache=None, quality: int = 85) -> bytes:
+    return load_image(path, max_side, thumb_cache, quality)[0]
+
+def load_image(path: str, max_side: int = 1024, thumb_cache=None, quality: int = 85) -> Tuple[bytes, int]:
+    # Returns (upload bytes, dhash); the hash comes from the same decode.
+    source_bytes = os.path.getsize(path)
+    with Image.open(path) as img:
+        w, h = img.size
+        orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+        passthrough = (
+            img.format == "JPEG"
+            and img.mode == "RGB"
+            and max(w, h) <= max_side
+            and orientation == 1
+            and source_bytes <= PASSTHROUGH_MAX_BYTES
+        )
+        if img.mode in ("P", "1"):
+            img = img.convert("RGB")
+        # thumbnail() uses JPEG draft mode and Image.reduce() to shrink by an
+        # integer factor before the final resample, so large originals are
+        # never fully decoded.
+        img.thumbnail((max_side, max_side), Image.Resampling.BICUBIC, reducing_gap=2.0)
+        img = ImageOps.exif_transpose(img).convert("RGB")
+
+    phash = dhash(img)
+    if thumb_cache is not None:
+        try:
+            thumb_cache.put_image(path, img)
+        except Exception:
+            pass
+
+    if passthrough:
+        with open(path, "rb") as f:
+            data = f.read()
+    else:
+        buf = BytesIO()
+        img.save(buf, format="JPEG", quality=quality)
+        data = buf.getvalue()
+    UPLOAD_STATS.record(source_bytes, len(data), passthrough)
+    return data, phash
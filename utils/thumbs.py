@@ -0,0 +1,133 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+from utils.metrics import METRICS
+
+THUMB_PX = 220
+THUMB_QUALITY = 80
+PREVIEW_PX = int(os.getenv("PREVIEW_PX") or 1600)
+THUMB_DIR = Path(__file__).resolve().parent.parent / ".thumbs"
+MAX_CACHE_BYTES = int(os.getenv("THUMB_CACHE_MB") or 512) * 1024 * 1024
+MAX_PREVIEW_BYTES = int(os.getenv("PREVIEW_CACHE_MB") or 512) * 1024 * 1024
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS") or min(8, os.cpu_count() or 1))
+
+class ThumbCache:
+    # Thumbnails are keyed by source path, mtime and size, so an edited file
+    # gets a fresh entry and stale ones age out. A file's mtime doubles as
+    # its last-access time for LRU eviction.
+    def __init__(self, root: Path = THUMB_DIR, px: int = THUMB_PX, max_bytes: int = MAX_CACHE_BYTES):
+        self.root = Path(root)
+        self.px = px
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total: Optional[int] = None
+
+    def _entry(self, path: str, st: Optional[os.stat_result] = None) -> Path:
+        st = st or os.stat(path)
+        key = hashlib.sha1(f"{path}|{st.st_mtime_ns}|{st.st_size}|{self.px}".encode("utf-8")).hexdigest()
+        return self.root / key[:2] / f"{key}.jpg"
+
+    def get(self, path: str) -> Optional[bytes]:
+        try:
+            entry = self._entry(path)
+            data = entry.read_bytes()
+        except OSError:
+            return None
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return data
+
+    def put_image(self, path: str, img: Image.Image, st: Optional[os.stat_result] = None) -> bytes:
+        thumb = img.copy()
+        thumb.thumbnail((self.px, self.px))
+        buf = BytesIO()
+        thumb.convert("RGB").save(buf, format="JPEG", quality=THUMB_QUALITY)
+        data = buf.getvalue()
+
+        entry = self._entry(path, st)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp = entry.with_name(f"{entry.stem}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        tmp.replace(entry)
+        self._account(len(data))
+        return data
+
+    def get_or_create(self, path: str) -> bytes:
+        data = self.get(path)
+        METRICS.inc("thumb_cache_total", size=self.px, result="miss" if data is None else "hit")
+        if data is not None:
+            return data
+        st = os.stat(path)
+        with METRICS.timer("thumb_render_seconds", size=self.px):
+            with Image.open(path) as img:
+                img.draft("RGB", (self.px, self.px))
+                # Upright, like the thumbnails load_image stores while indexing.
+                return self.put_image(path, ImageOps.exif_transpose(img).convert("RGB"), st)
+
+    def _account(self, added: int):
+        with self._lock:
+            if self._total is None:
+                self._total = sum(f.stat().st_size for f in self.root.glob("*/*.jpg"))
+            else:
+                self._total += added
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = []
+        for f in self.root.glob("*/*.jpg"):
+            try:
+                st = f.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, f))
+        entries.sort()
+        total = sum(size for (_m, size, _f) in entries)
+        target = int(self.max_bytes * 0.9)
+        for _mtime, size, f in entries:
+            if total <= target:
+                break
+            try:
+                f.unlink()
+                total -= size
+            except OSError:
+                pass
+        self._total = total
+
+_CACHE = None
+
+def get_thumb_cache() -> ThumbCache:
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = ThumbCache()
+    return _CACHE
+
+_PREVIEWS = None
+
+def get_preview_cache() -> ThumbCache:
+    # Screen-sized copies for the full view, with their own size budget.
+    global _PREVIEWS
+    if _PREVIEWS is None:
+        _PREVIEWS = ThumbCache(root=get_thumb_cache().root / "previews", px=PREVIEW_PX, max_bytes=MAX_PREVIEW_BYTES)
+    return _PREVIEWS
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_thumb_pool() -> ThreadPoolExecutor:
+    # Shared across app reruns, so thumbnails still being made for a page
+    # the user already left keep landing in the cache.
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix="thumbs")
+        return _POOL